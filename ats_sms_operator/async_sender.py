@@ -0,0 +1,183 @@
+"""
+Asyncio counterparts of the sender functions, available on Python 3 only.
+
+HTTP requests to ATS are non-blocking if the aiohttp library is installed, otherwise (or if ATS_ASYNC_USE_AIOHTTP
+is turned off) they are sent from a thread through the standard requests. Requests sent by aiohttp are measured
+the same way but they are not logged by django-security, turn aiohttp off if the requests must be logged. Database
+queries use the Django async ORM where available, the rest is run through asgiref's sync_to_async (or a thread
+of the default executor if asgiref is not installed).
+
+Every event loop has its own aiohttp session, close_client_session() should be awaited before the loop is closed.
+"""
+import asyncio
+import weakref
+from functools import partial
+
+from django.template import Context
+from django.utils.translation import ugettext
+
+from ats_sms_operator import config, metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+
+_client_sessions = weakref.WeakKeyDictionary()
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Runs the given blocking function outside of the event loop.
+    """
+    if sync_to_async is not None:
+        return await sync_to_async(func)(*args, **kwargs)
+    else:
+        return await asyncio.get_event_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+async def _call_orm(obj, method_name, *args, **kwargs):
+    async_method = getattr(obj, 'a{}'.format(method_name), None)
+    if async_method is not None:
+        return await async_method(*args, **kwargs)
+    else:
+        return await run_sync(getattr(obj, method_name), *args, **kwargs)
+
+
+def get_client_session():
+    """
+    Returns aiohttp client session with a pool of kept-alive connections shared by the running event loop.
+    """
+    loop = asyncio.get_event_loop()
+    session = _client_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config.ATS_HTTP_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(sock_connect=config.ATS_HTTP_CONNECT_TIMEOUT,
+                                          sock_read=config.ATS_HTTP_READ_TIMEOUT),
+        )
+        _client_sessions[loop] = session
+    return session
+
+
+async def close_client_session():
+    """
+    Closes aiohttp client session of the running event loop and its kept-alive connections.
+    """
+    session = _client_sessions.pop(asyncio.get_event_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+async def async_send_ats_requests(*ats_serializable_objects):
+    """
+    Performs the actual POST request with the given elementary ATS requests and returns text of the response.
+    """
+    from ats_sms_operator.circuit_breaker import circuit_breaker
+    from ats_sms_operator.sender import (SMSSendingError, check_circuit_breaker, get_retry_delay,
+                                         release_ats_requests_budget, send_ats_requests, serialize_ats_requests,
+                                         throttle_ats_requests)
+
+    if aiohttp is None or not config.ATS_ASYNC_USE_AIOHTTP:
+        return (await run_sync(send_ats_requests, *ats_serializable_objects)).text
+
+    check_circuit_breaker()
+    await run_sync(throttle_ats_requests, *ats_serializable_objects)
+    requests_xml = serialize_ats_requests(*ats_serializable_objects).encode('utf-8')
+    metrics.observe('ats_sms_request_size', len(ats_serializable_objects))
+    retry = 0
+    while True:
+        metrics.observe('ats_sms_request_bytes', len(requests_xml))
+        try:
+            with metrics.timer('ats_sms_request_seconds'):
+                async with get_client_session().post(config.ATS_URL, data=requests_xml,
+                                                     headers={'Content-Type': 'text/xml'}) as response:
+                    response_body = await response.read()
+        except aiohttp.ClientConnectorError as e:
+            metrics.increment('ats_sms_request_errors_total', error=e.__class__.__name__)
+            # Only requests whose connection was not established are retried, other requests could reach ATS
+            if retry < config.ATS_RETRY_MAX_RETRIES:
+                retry += 1
+                await asyncio.sleep(get_retry_delay(retry))
+                continue
+            circuit_breaker.record_failure()
+            await run_sync(release_ats_requests_budget, *ats_serializable_objects)
+            raise SMSSendingError(str(e))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.increment('ats_sms_request_errors_total', error=e.__class__.__name__)
+            circuit_breaker.record_failure()
+            raise SMSSendingError(str(e))
+        else:
+            metrics.observe('ats_sms_response_bytes', len(response_body))
+            if response.status >= 500:
+                metrics.increment('ats_sms_request_errors_total', error='HTTP{}'.format(response.status))
+                circuit_breaker.record_failure()
+                await run_sync(release_ats_requests_budget, *ats_serializable_objects)
+                raise SMSSendingError(ugettext('ATS responded with HTTP status {}').format(response.status))
+            circuit_breaker.record_success()
+            return response_body.decode(response.get_encoding())
+
+
+async def async_send_and_parse_response(*ats_requests):
+    """
+    Glue function to perform sending ATS requests and parsing the ATS server response in one go.
+    """
+    from ats_sms_operator.sender import parse_response_codes
+
+    return parse_response_codes(await async_send_ats_requests(*ats_requests))
+
+
+async def async_send_and_update_sms_states(*ats_requests):
+    """
+    Glue function to perform sending ATS requests and updating the corresponsing SMS states in one go.
+    """
+    from ats_sms_operator.sender import update_sms_states
+
+    await run_sync(update_sms_states, await async_send_and_parse_response(*ats_requests))
+
+
+async def async_send_template(recipient, slug='', context=None, deferred=None, **sms_attrs):
+    """
+    Use this function to send an SMS template to a given number from a coroutine. Deferred SMS (by default according
+    to ATS_SEND_DEFERRED) is only stored to the outbox as in send_template().
+    """
+    from ats_sms_operator.outbox import outbox_sender
+    from ats_sms_operator.sender import (SMSSendingError, get_compiled_sms_template_or_raise, is_sent_to_ats,
+                                         update_sms_state_from_response)
+
+    context = context or {}
+    deferred = config.ATS_SEND_DEFERRED if deferred is None else deferred
+    template = await run_sync(get_compiled_sms_template_or_raise, slug, recipient)
+    if not is_sent_to_ats(recipient):
+        state = config.ATS_STATES.DEBUG
+    elif deferred:
+        state = config.ATS_STATES.LOCAL_TO_SEND
+    else:
+        state = config.ATS_STATES.PROCESSING
+
+    output_sms = await _call_orm(
+        config.get_output_sms_model().objects, 'create',
+        recipient=recipient,
+        template_slug=slug,
+        content=template.render(Context(context)),
+        state=state,
+        **sms_attrs
+    )
+    if state == config.ATS_STATES.LOCAL_TO_SEND:
+        await run_sync(outbox_sender.enqueue_on_commit, output_sms.pk)
+    elif state == config.ATS_STATES.PROCESSING:
+        try:
+            parsed_response = await async_send_and_parse_response(output_sms)
+            update_sms_state_from_response(output_sms, parsed_response)
+        except SMSSendingError:
+            output_sms.state = config.ATS_STATES.LOCAL_TO_SEND
+            await _call_orm(output_sms, 'save')
+            raise
+        await _call_orm(output_sms, 'save')
+    return output_sms
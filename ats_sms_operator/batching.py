@@ -0,0 +1,62 @@
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from ats_sms_operator import config, metrics
+
+
+LOGGER = logging.getLogger('ats_sms')
+
+
+class AdaptiveBatchSizer(object):
+    """
+    Controls size of batches of SMS sent in one ATS request according to the observed ATS requests (AIMD).
+    The size grows by `increase_step` after every full batch sent faster than `target_duration` seconds and it is
+    halved (`decrease_factor`) after a failed or slow request. If the request body was larger than `max_bytes`,
+    the size is reduced proportionally. The size is always kept between `min_size` and `max_size`.
+    """
+
+    def __init__(self, min_size=None, max_size=None, initial_size=None, target_duration=None, max_bytes=None,
+                 increase_step=None, decrease_factor=0.5):
+        self.min_size = min_size or config.ATS_ADAPTIVE_BATCH_MIN_SIZE
+        self.max_size = max_size or config.ATS_ADAPTIVE_BATCH_MAX_SIZE
+        self.target_duration = target_duration or config.ATS_ADAPTIVE_BATCH_TARGET_DURATION
+        self.max_bytes = max_bytes or config.ATS_ADAPTIVE_BATCH_MAX_BYTES
+        self.increase_step = increase_step or config.ATS_ADAPTIVE_BATCH_INCREASE_STEP
+        self.decrease_factor = decrease_factor
+        self._lock = threading.Lock()
+        self._size = self._clamp(initial_size or config.ATS_SEND_BATCH_SIZE)
+
+    def _clamp(self, size):
+        return max(self.min_size, min(self.max_size, size))
+
+    @property
+    def batch_size(self):
+        return int(self._size)
+
+    def _set_size(self, size):
+        with self._lock:
+            old_batch_size = self.batch_size
+            self._size = self._clamp(size)
+        if self.batch_size != old_batch_size:
+            LOGGER.info('ATS batch size changed from {} to {}'.format(old_batch_size, self.batch_size))
+            metrics.observe('ats_sms_adaptive_batch_size', self.batch_size)
+
+    def record_success(self, size, duration, payload_bytes=None):
+        """
+        Records ATS request with `size` elementary requests that took `duration` seconds.
+        """
+        if self.max_bytes and payload_bytes and payload_bytes > self.max_bytes:
+            self._set_size(min(self._size, size * float(self.max_bytes) / payload_bytes))
+        elif duration > self.target_duration:
+            self._set_size(self._size * self.decrease_factor)
+        elif size >= self.batch_size:
+            # Only a full batch proves that the larger batch can be sent
+            self._set_size(self._size + self.increase_step)
+
+    def record_failure(self, size):
+        """
+        Records failed ATS request with `size` elementary requests.
+        """
+        self._set_size(self._size * self.decrease_factor)
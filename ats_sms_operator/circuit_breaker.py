@@ -0,0 +1,74 @@
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from ats_sms_operator import config
+
+
+LOGGER = logging.getLogger('ats_sms')
+
+
+class CircuitBreaker(object):
+    """
+    Process-local circuit breaker of requests to ATS. The circuit is opened after `failure_threshold` consecutive
+    failures and requests are not allowed while it is open. After `reset_timeout` seconds one request is allowed
+    to probe whether ATS has recovered (half-open state), its success closes the circuit and its failure opens it
+    again. If the probe does not report its result within `reset_timeout` seconds, another probe is allowed.
+    The circuit breaker is turned off if `failure_threshold` is not set.
+    """
+
+    def __init__(self, failure_threshold=None, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow_request(self):
+        if not self.failure_threshold:
+            return True
+
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            now = time.time()
+            if now - max(self._opened_at, self._probe_started_at or 0) < self.reset_timeout:
+                return False
+            self._probe_started_at = now
+            return True
+
+    def record_success(self):
+        if self._failures or self._opened_at is not None:
+            with self._lock:
+                if self._opened_at is not None:
+                    LOGGER.info('ATS circuit breaker was closed')
+                self._failures = 0
+                self._opened_at = self._probe_started_at = None
+
+    def record_failure(self):
+        if not self.failure_threshold:
+            return
+
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    LOGGER.warning('ATS circuit breaker was opened after {} failures'.format(self._failures))
+                self._opened_at = time.time()
+                self._probe_started_at = None
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = self._probe_started_at = None
+
+
+circuit_breaker = CircuitBreaker(config.ATS_CIRCUIT_BREAKER_THRESHOLD, config.ATS_CIRCUIT_BREAKER_RESET_TIMEOUT)
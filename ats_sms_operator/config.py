@@ -21,8 +21,49 @@ ATS_PASSWORD = getattr(settings, 'ATS_PASSWORD')
 ATS_URL = getattr(settings, 'ATS_URL', 'https://fik.atspraha.cz/gwfcgi/XMLServerWrapper.fcgi')
 ATS_USE_ACCENT = getattr(settings, 'ATS_USE_ACCENT', False)
 ATS_WHITELIST = getattr(settings, 'ATS_WHITELIST', ())
-ATS_PROCESSING_TIMEOUT = getattr(settings, 'ATS_PROCESSING_TIMEOUT', 10)
+# In seconds, must be longer than the worst-case time of sending a claimed batch (waiting for the rate limiter,
+# ATS_HTTP_READ_TIMEOUT and retries), otherwise SMS being sent are moved to TIMEOUT by clean_processing_sms
+ATS_PROCESSING_TIMEOUT = getattr(settings, 'ATS_PROCESSING_TIMEOUT', 10 * 60)
 ATS_UNIQ_PREFIX = getattr(settings, 'ATS_UNIQ_PREFIX', '')  # To mitigate conflicts in uniqs on production and accept
+ATS_SEND_BATCH_SIZE = getattr(settings, 'ATS_SEND_BATCH_SIZE', 1000)  # Max. number of SMS sent in one ATS request
+ATS_STREAM_REQUESTS = getattr(settings, 'ATS_STREAM_REQUESTS', False)  # Send requests with chunked encoding
+ATS_SEND_DEFERRED = getattr(settings, 'ATS_SEND_DEFERRED', False)  # Do not send SMS from send_template immediately
+ATS_OUTBOX_THREAD = getattr(settings, 'ATS_OUTBOX_THREAD', True)  # Send deferred SMS from a background thread
+ATS_SEND_WORKERS = getattr(settings, 'ATS_SEND_WORKERS', 1)  # Number of ATS requests sent concurrently
+ATS_SEND_PIPELINE_QUEUE_SIZE = getattr(settings, 'ATS_SEND_PIPELINE_QUEUE_SIZE', 2)  # Serialized batches waiting
+ATS_SEND_ADAPTIVE_BATCH_SIZE = getattr(settings, 'ATS_SEND_ADAPTIVE_BATCH_SIZE', False)  # Adapt size to ATS
+ATS_ADAPTIVE_BATCH_MIN_SIZE = getattr(settings, 'ATS_ADAPTIVE_BATCH_MIN_SIZE', 10)
+ATS_ADAPTIVE_BATCH_MAX_SIZE = getattr(settings, 'ATS_ADAPTIVE_BATCH_MAX_SIZE', 5000)
+ATS_ADAPTIVE_BATCH_TARGET_DURATION = getattr(settings, 'ATS_ADAPTIVE_BATCH_TARGET_DURATION', 5)  # In seconds
+ATS_ADAPTIVE_BATCH_MAX_BYTES = getattr(settings, 'ATS_ADAPTIVE_BATCH_MAX_BYTES', None)  # Max. size of request body
+ATS_ADAPTIVE_BATCH_INCREASE_STEP = getattr(settings, 'ATS_ADAPTIVE_BATCH_INCREASE_STEP', 50)
+ATS_SEND_COMPACT_RECORDS = getattr(settings, 'ATS_SEND_COMPACT_RECORDS', False)  # send_sms loads only needed columns
+ATS_INPUT_SMS_BULK_CREATE = getattr(settings, 'ATS_INPUT_SMS_BULK_CREATE', False)  # Bulk create input SMS
+ATS_SMS_TEMPLATE_CACHE_SIZE = getattr(settings, 'ATS_SMS_TEMPLATE_CACHE_SIZE', 100)  # 0 disables the cache
+ATS_SMS_TEMPLATE_CACHE_BACKEND = getattr(settings, 'ATS_SMS_TEMPLATE_CACHE_BACKEND', None)  # Alias of shared cache
+ATS_SHARDS = getattr(settings, 'ATS_SHARDS', 1)  # Number of processes sending SMS and checking their delivery at once
+ATS_SHARD = getattr(settings, 'ATS_SHARD', 0)  # Shard handled by this process, from 0 to ATS_SHARDS - 1
+ATS_SHARD_BY = getattr(settings, 'ATS_SHARD_BY', 'pk')  # SMS are sent by shards of "pk" or "recipient"
+ATS_DLR_BATCH_SIZE = getattr(settings, 'ATS_DLR_BATCH_SIZE', 1000)  # Max. number of SMS checked in one ATS request
+ATS_DLR_MIN_CHECK_INTERVAL = getattr(settings, 'ATS_DLR_MIN_CHECK_INTERVAL', 60)  # In seconds
+ATS_DLR_MAX_CHECK_INTERVAL = getattr(settings, 'ATS_DLR_MAX_CHECK_INTERVAL', 60 * 60)  # In seconds
+ATS_DLR_GRACE_PERIOD = getattr(settings, 'ATS_DLR_GRACE_PERIOD', 10 * 60)  # Checking after validity, in seconds
+ATS_WORKER_MIN_POLL_INTERVAL = getattr(settings, 'ATS_WORKER_MIN_POLL_INTERVAL', 1)  # In seconds
+ATS_WORKER_MAX_POLL_INTERVAL = getattr(settings, 'ATS_WORKER_MAX_POLL_INTERVAL', 30)  # In seconds
+ATS_RATE_LIMIT_PER_SECOND = getattr(settings, 'ATS_RATE_LIMIT_PER_SECOND', None)  # Max. SMS sent per second
+ATS_RATE_LIMIT_PER_DAY = getattr(settings, 'ATS_RATE_LIMIT_PER_DAY', None)  # Max. SMS sent per day
+ATS_RATE_LIMIT_CACHE_BACKEND = getattr(settings, 'ATS_RATE_LIMIT_CACHE_BACKEND', 'default')  # Alias of shared cache
+ATS_HTTP_POOL_SIZE = getattr(settings, 'ATS_HTTP_POOL_SIZE', 10)  # Max. number of kept-alive connections to ATS
+ATS_HTTP_CONNECT_TIMEOUT = getattr(settings, 'ATS_HTTP_CONNECT_TIMEOUT', 5)  # In seconds
+ATS_HTTP_READ_TIMEOUT = getattr(settings, 'ATS_HTTP_READ_TIMEOUT', 60)  # In seconds
+ATS_HTTP_MAX_RETRIES = getattr(settings, 'ATS_HTTP_MAX_RETRIES', 0)  # Retries of failed connection attempts
+ATS_RETRY_MAX_RETRIES = getattr(settings, 'ATS_RETRY_MAX_RETRIES', 0)  # Retries of requests after connection error
+ATS_RETRY_BASE_DELAY = getattr(settings, 'ATS_RETRY_BASE_DELAY', 0.5)  # In seconds, doubled with every retry
+ATS_RETRY_MAX_DELAY = getattr(settings, 'ATS_RETRY_MAX_DELAY', 10)  # In seconds
+ATS_CIRCUIT_BREAKER_THRESHOLD = getattr(settings, 'ATS_CIRCUIT_BREAKER_THRESHOLD', None)  # Failures opening circuit
+ATS_CIRCUIT_BREAKER_RESET_TIMEOUT = getattr(settings, 'ATS_CIRCUIT_BREAKER_RESET_TIMEOUT', 30)  # In seconds
+ATS_METRICS_BACKEND = getattr(settings, 'ATS_METRICS_BACKEND', None)  # Path to metrics backend class
+ATS_ASYNC_USE_AIOHTTP = getattr(settings, 'ATS_ASYNC_USE_AIOHTTP', True)  # Requests are not logged if set
 
 
 def get_input_sms_model():
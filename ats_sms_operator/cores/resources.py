@@ -1,19 +1,23 @@
 from __future__ import unicode_literals
 
+import logging
 from datetime import datetime
+from collections import Counter
 from itertools import chain
 
+import django
 from django.conf import settings
-from django.db import IntegrityError
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
 from django.utils import timezone
-from django.utils.encoding import force_text
 
 from chamber.exceptions import PersistenceException
 
-from bs4 import BeautifulSoup
 from ipware.ip import get_ip
 
-from ats_sms_operator import config
+from ats_sms_operator import config, metrics
+from ats_sms_operator.sender import MAX_IN_LOOKUP_SIZE, chunks, iter_chunks
+from ats_sms_operator.xml_utils import XMLParseError, iter_xml_elements
 
 
 # TODO remove the try-except once old is-core does not have to be supported
@@ -23,6 +27,14 @@ except ImportError:
     from is_core.rest.resource import RestResource as RESTResource
 
 
+LOGGER = logging.getLogger('ats_sms')
+
+INPUT_MESSAGE_FIELDS = ('uniq', 'sender', 'recipient', 'okey', 'opid', 'opmid', 'content')
+
+# Conflicting rows are ignored by the database if Django supports it
+BULK_CREATE_KWARGS = {'ignore_conflicts': True} if django.VERSION >= (2, 2) else {}
+
+
 def merge(origin, *args):
     """
     Merges given dictionaries, `origin` will not be changed.
@@ -34,18 +46,30 @@ def merge(origin, *args):
     return copy
 
 
+def iter_input_messages(source):
+    """
+    Incrementally parses ATS payload from the given file-like object and yields one dictionary per <sms> element.
+    Only one message is kept in memory at a time. If the payload is not well-formed, the error is logged and
+    messages following the error are not yielded.
+    """
+    try:
+        for sms in iter_xml_elements(source, 'sms'):
+            yield merge(dict(sms.attrib), {'content': sms.text or ''})
+    except XMLParseError as ex:
+        LOGGER.warning('ATS input messages cannot be parsed: {}'.format(ex))
+
+
 class InputATSSMSmessageResource(RESTResource):
     login_required = False
 
-    def __init__(self, request, callback_function):
+    def __init__(self, request, callback_function, bulk_create=None):
         super(InputATSSMSmessageResource, self).__init__(request)
         self.callback_function = callback_function
+        self.bulk_create = config.ATS_INPUT_SMS_BULK_CREATE if bulk_create is None else bulk_create
 
     def _deserialize(self):
-        soup = BeautifulSoup(force_text(self.request.body), 'html.parser')
-
-        self.request.data = ([merge(msg.attrs, {'content': msg.string or ''}) for msg in soup.messages.find_all('sms')]
-                             if soup.messages else ())
+        # Request is a file-like object, messages are parsed while the request body is being read
+        self.request.data = iter_input_messages(self.request)
         return self.request
 
     def _serialize(self, result):
@@ -55,28 +79,123 @@ class InputATSSMSmessageResource(RESTResource):
             ('</status>',)
         )), 'text/xml'
 
+    def _get_input_message_lookup(self, message):
+        return merge(
+            {k: v for k, v in message.items() if k in INPUT_MESSAGE_FIELDS},
+            {'received_at': timezone.make_aware(datetime.strptime(message.get('ts'), "%Y-%m-%d %H:%M:%S"),
+                                                timezone.get_default_timezone())}
+        )
+
     def _get_or_create_input_message(self, message):
         try:
-            return config.get_input_sms_model().objects.get_or_create(
-                received_at=timezone.make_aware(datetime.strptime(message.get('ts'), "%Y-%m-%d %H:%M:%S"),
-                                                timezone.get_default_timezone()),
-                **{k: v for k, v in message.items()
-                   if k in ('uniq', 'sender', 'recipient', 'okey', 'opid', 'opmid', 'content')}
-            )
+            return config.get_input_sms_model().objects.get_or_create(**self._get_input_message_lookup(message))
         except (IntegrityError, TypeError, PersistenceException, ValueError):
             return (None, False)
 
-    def post(self):
-        data = self.request.data
+    def _build_input_message(self, message):
+        """
+        Returns lookup and validated unsaved input message for the given message, or (None, None) if it is invalid.
+        """
+        try:
+            lookup = self._get_input_message_lookup(message)
+            input_message = config.get_input_sms_model()(**lookup)
+            input_message.full_clean(validate_unique=False)
+            return lookup, input_message
+        except (TypeError, ValidationError, ValueError):
+            return None, None
+
+    def _is_same_input_message(self, lookup, input_message, other_input_message):
+        return all(getattr(input_message, field_name) == getattr(other_input_message, field_name)
+                   for field_name in lookup)
+
+    def _bulk_get_or_create_input_messages(self, messages):
+        """
+        Bulk alternative of calling _get_or_create_input_message() for every message. Existing messages are fetched
+        by one query (per chunk of uniqs) and the new ones are created with bulk_create, therefore model save hooks
+        are not called for them. Returns triples (message, input message or None, created) in the order of messages.
+        """
+        input_sms_model = config.get_input_sms_model()
+        built_messages = [(message,) + self._build_input_message(message) for message in messages]
+        uniqs = set(input_message.uniq for _, _, input_message in built_messages if input_message)
+        existing_input_messages = {
+            input_message.uniq: input_message
+            for uniqs_chunk in chunks(uniqs, MAX_IN_LOOKUP_SIZE)
+            for input_message in input_sms_model.objects.filter(uniq__in=uniqs_chunk)
+        }
+
+        new_input_messages = {}
+        for _, _, input_message in built_messages:
+            if (input_message and input_message.uniq not in existing_input_messages and
+                    input_message.uniq not in new_input_messages):
+                new_input_messages[input_message.uniq] = input_message
+
+        created_uniqs = set(new_input_messages.keys())
+        if new_input_messages:
+            ignored_conflicts = bool(BULK_CREATE_KWARGS)
+            try:
+                with transaction.atomic():
+                    input_sms_model.objects.bulk_create(new_input_messages.values(), **BULK_CREATE_KWARGS)
+            except IntegrityError:
+                ignored_conflicts = False
+                # Some of the messages were created concurrently, fall back to creating messages one by one
+                for uniq, input_message in new_input_messages.items():
+                    lookup = dict((k, getattr(input_message, k)) for k in INPUT_MESSAGE_FIELDS + ('received_at',))
+                    try:
+                        if not input_sms_model.objects.get_or_create(**lookup)[1]:
+                            created_uniqs.remove(uniq)
+                    except (IntegrityError, PersistenceException):
+                        created_uniqs.remove(uniq)
+            stored_input_messages = merge(existing_input_messages, {
+                input_message.uniq: input_message
+                for uniqs_chunk in chunks(new_input_messages.keys(), MAX_IN_LOOKUP_SIZE)
+                for input_message in input_sms_model.objects.filter(uniq__in=uniqs_chunk)
+            })
+            if ignored_conflicts:
+                # Rows inserted concurrently were skipped by the database, only the rows with creation time set
+                # by this bulk_create were created by this request
+                created_uniqs = set(
+                    uniq for uniq in created_uniqs
+                    if uniq in stored_input_messages and
+                    stored_input_messages[uniq].created_at == new_input_messages[uniq].created_at
+                )
+        else:
+            stored_input_messages = existing_input_messages
+
         result = []
-        for message in data:
-            input_message, created = self._get_or_create_input_message(message)
-            if input_message:
-                self.callback_function(input_message, created)
-                result.append((config.ATS_STATES.DELIVERED, input_message.uniq))
+        for message, lookup, input_message in built_messages:
+            stored_input_message = stored_input_messages.get(input_message.uniq) if input_message else None
+            if stored_input_message and self._is_same_input_message(lookup, input_message, stored_input_message):
+                # Input message is created only once, its duplicates within the payload are just found
+                created = input_message.uniq in created_uniqs
+                created_uniqs.discard(input_message.uniq)
+                result.append((message, stored_input_message, created))
             else:
-                result.append((config.ATS_STATES.NOT_DELIVERED, message.get('uniq', '')))
+                result.append((message, None, False))
+        return result
 
+    def post(self):
+        with metrics.timer('ats_sms_input_seconds'):
+            if self.bulk_create:
+                # Messages are processed in chunks, the whole payload is never kept in memory
+                processed_messages = chain.from_iterable(
+                    self._bulk_get_or_create_input_messages(messages_chunk)
+                    for messages_chunk in iter_chunks(self.request.data, MAX_IN_LOOKUP_SIZE)
+                )
+            else:
+                processed_messages = ((message,) + tuple(self._get_or_create_input_message(message))
+                                      for message in self.request.data)
+
+            result = []
+            for message, input_message, created in processed_messages:
+                if input_message:
+                    self.callback_function(input_message, created)
+                    result.append((config.ATS_STATES.DELIVERED, input_message.uniq))
+                else:
+                    result.append((config.ATS_STATES.NOT_DELIVERED, message.get('uniq', '')))
+
+        metrics.observe('ats_sms_input_size', len(result))
+        for code, count in Counter(code for code, _ in result).items():
+            metrics.increment('ats_sms_input_codes_total', count, code=code)
         return result
 
     def has_post_permission(self, *args, **kwargs):
@@ -1,32 +1,93 @@
 """
 If the django-security library is present in the system, we want to log HTTP requests
 using its modified get(), post() etc. functions instead of standard the requests library.
+
+All requests are sent through one process-wide session to keep connections to ATS alive between requests.
+If the installed django-security library does not provide a session class, its functions are used directly
+so that requests are still logged.
 """
 
+import threading
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from ats_sms_operator import config
+
 try:
+    from security.transport import security_requests
     from security.transport.security_requests import *
 except ImportError:
+    security_requests = None
     from requests import *
-    from requests import (get as _get, options as _options, head as _head, post as _post, put as _put, patch as _patch,
-                          delete as _delete)
 
-    def get(url, slug=None, related_objects=None, **kwargs):
-        return _get(url, **kwargs)
 
-    def options(url, slug=None, related_objects=None, **kwargs):
-        return _options(url, **kwargs)
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session():
+    """
+    Returns new session with a pool of kept-alive connections and retries configured according to the settings.
+    """
+    session_class = getattr(security_requests, 'SecuritySession', Session)
+    session = session_class()
+    adapter = HTTPAdapter(pool_connections=config.ATS_HTTP_POOL_SIZE, pool_maxsize=config.ATS_HTTP_POOL_SIZE,
+                          max_retries=config.ATS_HTTP_MAX_RETRIES)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Returns the process-wide session, the session is created with the first call.
+    """
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def request(method, url, slug=None, related_objects=None, **kwargs):
+    kwargs.setdefault('timeout', (config.ATS_HTTP_CONNECT_TIMEOUT, config.ATS_HTTP_READ_TIMEOUT))
+    if security_requests is None:
+        return get_session().request(method, url, **kwargs)
+    elif hasattr(security_requests, 'SecuritySession'):
+        return get_session().request(method, url, slug=slug, related_objects=related_objects, **kwargs)
+    else:
+        return getattr(security_requests, method)(url, slug=slug, related_objects=related_objects, **kwargs)
+
+
+def get(url, slug=None, related_objects=None, **kwargs):
+    kwargs.setdefault('allow_redirects', True)
+    return request('get', url, slug=slug, related_objects=related_objects, **kwargs)
+
+
+def options(url, slug=None, related_objects=None, **kwargs):
+    kwargs.setdefault('allow_redirects', True)
+    return request('options', url, slug=slug, related_objects=related_objects, **kwargs)
+
+
+def head(url, slug=None, related_objects=None, **kwargs):
+    kwargs.setdefault('allow_redirects', False)
+    return request('head', url, slug=slug, related_objects=related_objects, **kwargs)
+
+
+def post(url, slug=None, related_objects=None, **kwargs):
+    return request('post', url, slug=slug, related_objects=related_objects, **kwargs)
+
 
-    def head(url, slug=None, related_objects=None, **kwargs):
-        return _head(url, **kwargs)
+def put(url, slug=None, related_objects=None, **kwargs):
+    return request('put', url, slug=slug, related_objects=related_objects, **kwargs)
 
-    def post(url, slug=None, related_objects=None, **kwargs):
-        return _post(url, **kwargs)
 
-    def put(url, slug=None, related_objects=None, **kwargs):
-        return _put(url, **kwargs)
+def patch(url, slug=None, related_objects=None, **kwargs):
+    return request('patch', url, slug=slug, related_objects=related_objects, **kwargs)
 
-    def patch(url, slug=None, related_objects=None, **kwargs):
-        return _patch(url, **kwargs)
 
-    def delete(url, slug=None, related_objects=None, **kwargs):
-        return _delete(url, **kwargs)
+def delete(url, slug=None, related_objects=None, **kwargs):
+    return request('delete', url, slug=slug, related_objects=related_objects, **kwargs)
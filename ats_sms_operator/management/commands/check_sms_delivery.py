@@ -1,15 +1,45 @@
 from __future__ import unicode_literals
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext
 
-from ats_sms_operator.config import ATS_STATES, get_output_sms_model
-from ats_sms_operator.sender import DeliveryRequest, send_and_update_sms_states
+from ats_sms_operator.config import ATS_DLR_BATCH_SIZE, ATS_SHARD, ATS_SHARDS, ATS_STATES, get_output_sms_model
+from ats_sms_operator.management.options import get_option_list
+from ats_sms_operator.records import DeliveryCheckRecord
+from ats_sms_operator.sender import ATSSMSException, LOGGER, check_sms_delivery_states, filter_shard, iter_batches
 
 
 class Command(BaseCommand):
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=None,
+                            help='Max. number of SMS checked in one ATS request (defaults to ATS_DLR_BATCH_SIZE).')
+        parser.add_argument('--shard', action='store', dest='shard', type=int, default=ATS_SHARD,
+                            help='Shard of SMS checked by this process, from 0 to --shards - 1 '
+                                 '(defaults to ATS_SHARD).')
+        parser.add_argument('--shards', action='store', dest='shards', type=int, default=ATS_SHARDS,
+                            help='Number of processes checking SMS at once (defaults to ATS_SHARDS).')
+
+    if hasattr(BaseCommand, 'option_list'):
+        # Django < 1.10 does not call add_arguments()
+        option_list = get_option_list(add_arguments)
+
     def handle(self, *args, **options):
+        shard, shards = options.get('shard', ATS_SHARD), options.get('shards', ATS_SHARDS)
+        if not 0 <= shard < shards:
+            raise CommandError('Shard must be from 0 to {}'.format(shards - 1))
+
         to_check = get_output_sms_model().objects.filter(
-            state__in=(ATS_STATES.OK, ATS_STATES.NOT_SENT, ATS_STATES.SENT))
-        if to_check.exists():
-            send_and_update_sms_states(*[DeliveryRequest(sms) for sms in to_check])
+            Q(next_dlr_check_at__isnull=True) | Q(next_dlr_check_at__lte=timezone.now()),
+            state__in=(ATS_STATES.OK, ATS_STATES.NOT_SENT, ATS_STATES.SENT), dlr=True)
+        # Order of delivery checks does not matter, SMS are always split to shards by pk
+        to_check = filter_shard(to_check, shard, shards)
+        for batch in iter_batches(to_check, options.get('batch_size') or ATS_DLR_BATCH_SIZE, DeliveryCheckRecord):
+            try:
+                check_sms_delivery_states(batch)
+            except ATSSMSException as ex:
+                LOGGER.error(ugettext('Checking delivery of {count} SMS failed: {error}').format(
+                    count=len(batch), error=force_text(ex)))
@@ -0,0 +1,77 @@
+from __future__ import unicode_literals
+
+import json
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ats_sms_operator.management.options import get_option_list
+from ats_sms_operator.simulator import ATSSimulator, parse_error_codes, parse_latency
+
+
+class Command(BaseCommand):
+    help = ('Runs offline simulator of the ATS gateway until it is terminated. Set ATS_URL to the printed URL to send '
+            'SMS to the simulator.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', action='store', dest='host', default='127.0.0.1', help='Host to listen on.')
+        parser.add_argument('--port', action='store', dest='port', type=int, default=8001, help='Port to listen on.')
+        parser.add_argument('--latency', action='store', dest='latency', default=None,
+                            help='Latency of responses: constant:<s>, uniform:<min>,<max>, exponential:<mean> or '
+                                 'lognormal:<mu>,<sigma>.')
+        parser.add_argument('--error', action='append', dest='errors', default=[],
+                            help='Injected error code with its probability, e.g. 334:0.01 or 705:0.001. '
+                                 'Can be repeated.')
+        parser.add_argument('--drop-rate', action='store', dest='drop_rate', type=float, default=0,
+                            help='Probability that the connection is closed without a response.')
+        parser.add_argument('--dlr-sent-after', action='store', dest='dlr_sent_after', type=float, default=0,
+                            help='Seconds after which accepted SMS are reported as sent.')
+        parser.add_argument('--dlr-delivered-after', action='store', dest='dlr_delivered_after', type=float,
+                            default=0, help='Seconds after which accepted SMS are reported as delivered.')
+        parser.add_argument('--undelivered-rate', action='store', dest='undelivered_rate', type=float, default=0,
+                            help='Probability that SMS is reported as not delivered.')
+        parser.add_argument('--mo-url', action='store', dest='mo_url', default=None,
+                            help='URL of the input SMS resource the MO messages are pushed to.')
+        parser.add_argument('--mo-interval', action='store', dest='mo_interval', type=float, default=1,
+                            help='Seconds between pushes of MO messages.')
+        parser.add_argument('--mo-batch-size', action='store', dest='mo_batch_size', type=int, default=10,
+                            help='Number of MO messages in one push.')
+        parser.add_argument('--seed', action='store', dest='seed', type=int, default=None,
+                            help='Seed of the random generator to make the simulation repeatable.')
+
+    if hasattr(BaseCommand, 'option_list'):
+        # Django < 1.10 does not call add_arguments()
+        option_list = get_option_list(add_arguments)
+
+    def _stop(self, signum, frame):
+        self.stopped.set()
+
+    def handle(self, *args, **options):
+        try:
+            simulator = ATSSimulator(
+                host=options.get('host', '127.0.0.1'),
+                port=options.get('port', 8001),
+                latency=parse_latency(options['latency']) if options.get('latency') else None,
+                error_codes=parse_error_codes(options.get('errors') or ()),
+                drop_rate=options.get('drop_rate') or 0,
+                dlr_sent_after=options.get('dlr_sent_after') or 0,
+                dlr_delivered_after=options.get('dlr_delivered_after') or 0,
+                undelivered_rate=options.get('undelivered_rate') or 0,
+                mo_url=options.get('mo_url'),
+                mo_interval=options.get('mo_interval') or 1,
+                mo_batch_size=options.get('mo_batch_size') or 10,
+                seed=options.get('seed'),
+            )
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        self.stopped = threading.Event()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        with simulator:
+            self.stdout.write('ATS simulator is running at {}'.format(simulator.url))
+            while not self.stopped.is_set():
+                self.stopped.wait(1)
+        self.stdout.write(json.dumps(simulator.stats, sort_keys=True))
@@ -0,0 +1,74 @@
+from __future__ import unicode_literals
+
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ats_sms_operator.batching import AdaptiveBatchSizer
+from ats_sms_operator.config import (ATS_SEND_ADAPTIVE_BATCH_SIZE, ATS_STATES, ATS_WORKER_MAX_POLL_INTERVAL,
+                                     ATS_WORKER_MIN_POLL_INTERVAL, get_output_sms_model)
+from ats_sms_operator.management.options import get_option_list
+from ats_sms_operator.sender import (LOGGER, claim_sms_batch, mark_sms_to_send, return_processing_sms_to_outbox,
+                                     send_and_update_sms_states_in_batches)
+
+
+class Command(BaseCommand):
+    help = ('Sends SMS in the LOCAL_TO_SEND state until it is terminated. More workers can run at once, every SMS is '
+            'claimed by one worker only. ATS_PROCESSING_TIMEOUT must be longer than the worst-case time of sending '
+            'a batch, otherwise the claimed SMS are moved to TIMEOUT by clean_processing_sms while being sent.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=None,
+                            help='Max. number of SMS sent in one ATS request (defaults to ATS_SEND_BATCH_SIZE).')
+        parser.add_argument('--adaptive', action='store_true', dest='adaptive', default=ATS_SEND_ADAPTIVE_BATCH_SIZE,
+                            help='Adapt the batch size to duration of ATS requests, --batch-size is the initial size.')
+        parser.add_argument('--min-poll-interval', action='store', dest='min_poll_interval', type=float,
+                            default=ATS_WORKER_MIN_POLL_INTERVAL, help='Seconds to wait when the outbox gets empty.')
+        parser.add_argument('--max-poll-interval', action='store', dest='max_poll_interval', type=float,
+                            default=ATS_WORKER_MAX_POLL_INTERVAL,
+                            help='Max. seconds to wait when the outbox stays empty.')
+
+    if hasattr(BaseCommand, 'option_list'):
+        # Django < 1.10 does not call add_arguments()
+        option_list = get_option_list(add_arguments)
+
+    def _stop(self, signum, frame):
+        self.stopped.set()
+
+    def handle(self, *args, **options):
+        self.stopped = threading.Event()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        min_poll_interval = options.get('min_poll_interval', ATS_WORKER_MIN_POLL_INTERVAL)
+        max_poll_interval = options.get('max_poll_interval', ATS_WORKER_MAX_POLL_INTERVAL)
+        sizer = (AdaptiveBatchSizer(initial_size=options.get('batch_size'))
+                 if options.get('adaptive', ATS_SEND_ADAPTIVE_BATCH_SIZE) else None)
+        poll_interval = min_poll_interval
+        outbox = get_output_sms_model().objects.filter(state=ATS_STATES.LOCAL_TO_SEND)
+        while not self.stopped.is_set():
+            close_old_connections()
+            batch = claim_sms_batch(outbox, sizer.batch_size if sizer else options.get('batch_size'))
+            if batch:
+                # The claimed batch is always sent (or returned to the outbox) before the worker stops
+                try:
+                    failed = send_and_update_sms_states_in_batches([batch], workers=1, on_failure=mark_sms_to_send,
+                                                                   sizer=sizer)
+                except Exception:  # The worker must not die and the claimed SMS must not be left in PROCESSING
+                    LOGGER.exception('Sending {} claimed SMS failed'.format(len(batch)))
+                    return_processing_sms_to_outbox([output_sms.pk for output_sms in batch])
+                    failed = 1
+                if failed:
+                    # The returned SMS are not claimed again at once (e.g. the rate limit is exceeded or ATS is down)
+                    self.stopped.wait(poll_interval)
+                    poll_interval = min(poll_interval * 2, max_poll_interval)
+                else:
+                    poll_interval = min_poll_interval
+            elif outbox.exists():
+                # SMS left in the outbox were claimed by the other workers at the same time, they are not waited for
+                poll_interval = min_poll_interval
+            else:
+                self.stopped.wait(poll_interval)
+                poll_interval = min(poll_interval * 2, max_poll_interval)
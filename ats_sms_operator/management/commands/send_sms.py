@@ -1,14 +1,68 @@
 from __future__ import unicode_literals
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from ats_sms_operator.config import ATS_STATES, get_output_sms_model
-from ats_sms_operator.sender import send_and_update_sms_states
+from ats_sms_operator.batching import AdaptiveBatchSizer
+from ats_sms_operator.config import (ATS_SEND_ADAPTIVE_BATCH_SIZE, ATS_SEND_COMPACT_RECORDS, ATS_SHARD,
+                                     ATS_SHARD_BY, ATS_SHARDS, ATS_STATES, get_output_sms_model)
+from ats_sms_operator.management.options import get_option_list
+from ats_sms_operator.records import OutputSMSRecord
+from ats_sms_operator.sender import (claim_batches, filter_recipient_shard, filter_shard, iter_batches,
+                                     mark_sms_to_send, return_processing_sms_to_outbox,
+                                     send_and_update_sms_states_in_batches)
 
 
 class Command(BaseCommand):
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=None,
+                            help='Max. number of SMS sent in one ATS request (defaults to ATS_SEND_BATCH_SIZE).')
+        parser.add_argument('--workers', action='store', dest='workers', type=int, default=None,
+                            help='Number of ATS requests sent concurrently (defaults to ATS_SEND_WORKERS).')
+        parser.add_argument('--adaptive', action='store_true', dest='adaptive', default=ATS_SEND_ADAPTIVE_BATCH_SIZE,
+                            help='Adapt the batch size to duration of ATS requests, --batch-size is the initial size.')
+        parser.add_argument('--pipelined', action='store_true', dest='pipelined', default=False,
+                            help='Fetch and serialize next batches while the previous batches are being sent.')
+        parser.add_argument('--queue-size', action='store', dest='queue_size', type=int, default=None,
+                            help='Max. number of serialized batches waiting to be sent in the pipelined mode '
+                                 '(defaults to ATS_SEND_PIPELINE_QUEUE_SIZE).')
+        parser.add_argument('--compact', action='store_true', dest='compact', default=ATS_SEND_COMPACT_RECORDS,
+                            help='Load only columns needed to send SMS instead of model instances.')
+        parser.add_argument('--shard', action='store', dest='shard', type=int, default=ATS_SHARD,
+                            help='Shard of SMS sent by this process, from 0 to --shards - 1 (defaults to ATS_SHARD).')
+        parser.add_argument('--shards', action='store', dest='shards', type=int, default=ATS_SHARDS,
+                            help='Number of processes sending SMS at once (defaults to ATS_SHARDS).')
+        parser.add_argument('--shard-by', action='store', dest='shard_by', choices=('pk', 'recipient'),
+                            default=ATS_SHARD_BY,
+                            help='Split SMS to shards by "pk" or "recipient" (defaults to ATS_SHARD_BY).')
+
+    if hasattr(BaseCommand, 'option_list'):
+        # Django < 1.10 does not call add_arguments()
+        option_list = get_option_list(add_arguments)
+
     def handle(self, *args, **options):
+        shard, shards = options.get('shard', ATS_SHARD), options.get('shards', ATS_SHARDS)
+        if not 0 <= shard < shards:
+            raise CommandError('Shard must be from 0 to {}'.format(shards - 1))
+        shard_by_recipient = options.get('shard_by', ATS_SHARD_BY) == 'recipient'
+
         messages = get_output_sms_model().objects.filter(state=ATS_STATES.LOCAL_TO_SEND)
-        if messages.exists():
-            send_and_update_sms_states(*list(messages))
+        if not shard_by_recipient:
+            messages = filter_shard(messages, shard, shards)
+        record_class = OutputSMSRecord if options.get('compact', ATS_SEND_COMPACT_RECORDS) else None
+        sizer = (AdaptiveBatchSizer(initial_size=options.get('batch_size'))
+                 if options.get('adaptive', ATS_SEND_ADAPTIVE_BATCH_SIZE) else None)
+        batches = iter_batches(messages, options.get('batch_size'), record_class, sizer)
+        if shard_by_recipient and shards > 1:
+            batches = filter_recipient_shard(batches, shard, shards)
+        # SMS are claimed before sending, the outbox thread or another process could be sending them at once
+        claimed_pks = []
+        try:
+            send_and_update_sms_states_in_batches(claim_batches(batches, claimed_pks), options.get('workers'),
+                                                  on_failure=mark_sms_to_send, sizer=sizer,
+                                                  pipelined=options.get('pipelined'),
+                                                  queue_size=options.get('queue_size'))
+        except Exception:
+            # Claimed SMS must not be left in PROCESSING, they would be moved to TIMEOUT and never sent
+            return_processing_sms_to_outbox(claimed_pks)
+            raise
@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+OPTPARSE_TYPES = {int: 'int', float: 'float', str: 'string'}
+
+
+class OptparseOptionsCollector(object):
+    """
+    Collects arguments added by add_arguments() of a command as optparse options.
+    """
+
+    def __init__(self):
+        self.options = []
+
+    def add_argument(self, *args, **kwargs):
+        if 'choices' in kwargs:
+            kwargs['type'] = 'choice'
+        elif 'type' in kwargs:
+            kwargs['type'] = OPTPARSE_TYPES[kwargs['type']]
+        self.options.append(make_option(*args, **kwargs))
+
+
+def get_option_list(add_arguments):
+    """
+    Returns option_list for Django < 1.10 (commands without argparse) with the options added by the given
+    add_arguments() method of the command.
+    """
+    collector = OptparseOptionsCollector()
+    add_arguments(None, collector)
+    return BaseCommand.option_list + tuple(collector.options)
@@ -0,0 +1,154 @@
+"""
+Metrics of sending and receiving SMS. Metrics are recorded to the backend set by the ATS_METRICS_BACKEND setting
+(a dotted path to a MetricsBackend subclass), by default they are not recorded at all.
+
+PrometheusMetricsBackend keeps the metrics in memory of the process and renders them in the Prometheus text format,
+the metrics_view can be added to urls to expose them.
+"""
+from __future__ import unicode_literals
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.http import HttpResponse
+
+from ats_sms_operator import config
+
+try:
+    from django.utils.module_loading import import_string
+except ImportError:
+    from django.utils.module_loading import import_by_path as import_string
+
+
+class MetricsBackend(object):
+    """
+    Metrics backend that does not record anything. Backends should override observe() to record a value
+    of a histogram and increment() to increase a counter.
+    """
+
+    def observe(self, name, value, labels=None):
+        pass
+
+    def increment(self, name, value=1, labels=None):
+        pass
+
+
+class PrometheusMetricsBackend(MetricsBackend):
+
+    SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    BYTES_BUCKETS = (1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+    SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get_buckets(self, name):
+        if name.endswith('_seconds'):
+            return self.SECONDS_BUCKETS
+        elif name.endswith('_bytes'):
+            return self.BYTES_BUCKETS
+        else:
+            return self.SIZE_BUCKETS
+
+    def _get_key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def observe(self, name, value, labels=None):
+        buckets = self.get_buckets(name)
+        with self._lock:
+            key = self._get_key(name, labels)
+            if key not in self._histograms:
+                self._histograms[key] = [[0] * len(buckets), 0, 0]
+            histogram = self._histograms[key]
+            bucket_index = bisect_left(buckets, value)
+            if bucket_index < len(buckets):
+                histogram[0][bucket_index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def increment(self, name, value=1, labels=None):
+        with self._lock:
+            key = self._get_key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def _format_sample(self, name, labels, value):
+        labels_str = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+        return '{}{{{}}} {}'.format(name, labels_str, value) if labels_str else '{} {}'.format(name, value)
+
+    def render(self):
+        """
+        Returns all recorded metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            typed_names = set()
+            for (name, labels), (bucket_counts, total, count) in sorted(self._histograms.items()):
+                if name not in typed_names:
+                    typed_names.add(name)
+                    lines.append('# TYPE {} histogram'.format(name))
+                cumulative_count = 0
+                for le, bucket_count in zip(self.get_buckets(name), bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(self._format_sample('{}_bucket'.format(name), labels + (('le', le),),
+                                                     cumulative_count))
+                lines.append(self._format_sample('{}_bucket'.format(name), labels + (('le', '+Inf'),), count))
+                lines.append(self._format_sample('{}_sum'.format(name), labels, total))
+                lines.append(self._format_sample('{}_count'.format(name), labels, count))
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed_names:
+                    typed_names.add(name)
+                    lines.append('# TYPE {} counter'.format(name))
+                lines.append(self._format_sample(name, labels, value))
+        return ''.join('{}\n'.format(line) for line in lines)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_metrics_backend():
+    """
+    Returns the process-wide metrics backend, the backend is created with the first call.
+    """
+    global _backend
+
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = (import_string(config.ATS_METRICS_BACKEND)() if config.ATS_METRICS_BACKEND
+                            else MetricsBackend())
+    return _backend
+
+
+def observe(name, value, **labels):
+    get_metrics_backend().observe(name, value, labels)
+
+
+def increment(name, value=1, **labels):
+    get_metrics_backend().increment(name, value, labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Observes duration of the with statement block in seconds.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def metrics_view(request):
+    """
+    Returns metrics recorded by PrometheusMetricsBackend. Access to the view should be restricted in urls
+    or by the web server.
+    """
+    backend = get_metrics_backend()
+    return HttpResponse(backend.render() if hasattr(backend, 'render') else '',
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -2,7 +2,8 @@ from __future__ import unicode_literals
 
 import six
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import class_prepared, post_delete, post_save
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
@@ -11,6 +12,8 @@ from chamber.utils import remove_accent
 
 from ats_sms_operator import config
 from ats_sms_operator.config import ATS_STATES
+from ats_sms_operator.records import serialize_ats_sms
+from ats_sms_operator.template_cache import sms_template_cache
 
 
 @python_2_unicode_compatible
@@ -53,6 +56,10 @@ class AbstractOutputATSSMSmessage(SmartModel):
     state = models.IntegerField(verbose_name=_('state'), null=False, blank=False, choices=STATE.choices,
                                 default=STATE.LOCAL_TO_SEND)
     template_slug = models.SlugField(max_length=100, null=True, blank=True, verbose_name=_('slug'))
+    next_dlr_check_at = models.DateTimeField(verbose_name=_('next delivery check at'), null=True, blank=True)
+    # Set by the process that claimed the SMS for sending if the database does not support SKIP LOCKED
+    claim_token = models.CharField(verbose_name=_('claim token'), null=True, blank=True, max_length=32,
+                                   editable=False)
 
     def clean_content(self):
         if not config.ATS_USE_ACCENT:
@@ -67,13 +74,8 @@ class AbstractOutputATSSMSmessage(SmartModel):
         self.kw = self.kw or config.ATS_PROJECT_KEYWORD
 
     def serialize_ats(self):
-        return """<sms type="text" uniq="{prefix}{uniq}" sender="{sender}" recipient="{recipient}" opmid="{opmid}"
-                      dlr="{dlr}" validity="{validity}" kw="{kw}">
-                        <body order="0" billing="{billing}">{content}</body>
-                  </sms>""".format(prefix=config.ATS_UNIQ_PREFIX, uniq=self.pk, sender=self.sender,
-                                   recipient=self.recipient, opmid=self.opmid, dlr=int(self.dlr),
-                                   validity=self.validity, kw=self.kw, billing=int(self.billing),
-                                   content=self.ascii_content)
+        return serialize_ats_sms(self.pk, self.sender, self.recipient, self.opmid, self.dlr, self.validity, self.kw,
+                                 self.billing, self.content)
 
     @property
     def ascii_content(self):
@@ -92,6 +94,13 @@ class AbstractOutputATSSMSmessage(SmartModel):
         verbose_name = _('output ATS message')
         verbose_name_plural = _('output ATS messages')
         ordering = ('-created_at',)
+        # Indexes used by the sending and delivery checking commands and by history lookups
+        index_together = (
+            ('state', 'id'),
+            ('state', 'changed_at'),
+            ('state', 'next_dlr_check_at'),
+            ('recipient', 'created_at'),
+        )
 
 
 @python_2_unicode_compatible
@@ -106,3 +115,28 @@ class AbstractSMSTemplate(SmartModel):
         abstract = True
         verbose_name = _('SMS template')
         verbose_name_plural = _('SMS templates')
+
+
+def invalidate_sms_template_cache(sender, instance, using=None, **kwargs):
+    """
+    Invalidates the cache immediately and again after the transaction is committed, because the old template
+    could be cached by another thread before the change is committed.
+    """
+    sms_template_cache.invalidate()
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(sms_template_cache.invalidate, using=using)
+
+
+def connect_sms_template_cache_invalidation(sender, **kwargs):
+    """
+    Connects invalidation of the cache to saving and deleting of SMS template models only.
+    """
+    if issubclass(sender, AbstractSMSTemplate) and not sender._meta.abstract:
+        post_save.connect(invalidate_sms_template_cache, sender=sender,
+                          dispatch_uid='invalidate_sms_template_cache_post_save')
+        post_delete.connect(invalidate_sms_template_cache, sender=sender,
+                            dispatch_uid='invalidate_sms_template_cache_post_delete')
+
+
+class_prepared.connect(connect_sms_template_cache_invalidation,
+                       dispatch_uid='connect_sms_template_cache_invalidation')
@@ -0,0 +1,75 @@
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from six.moves import queue
+
+from django.db import connection, transaction
+
+from ats_sms_operator import config
+
+
+LOGGER = logging.getLogger('ats_sms')
+
+
+class OutboxSender(object):
+    """
+    Sends deferred SMS (SMS created in the LOCAL_TO_SEND state) from a background daemon thread, so the thread that
+    created the SMS never waits for ATS. SMS that failed to be sent are returned to the outbox and SMS not claimed
+    by the thread yet stay there, both are sent by the send_sms command. SMS claimed by the thread are moved to
+    the PROCESSING state, if the process exits while they are being sent, they are left in this state and later
+    moved to TIMEOUT by the clean_processing_sms command.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ats-sms-outbox')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _get_pks(self):
+        pks = [self._queue.get()]
+        while len(pks) < self.batch_size:
+            try:
+                pks.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return pks
+
+    def _run(self):
+        from ats_sms_operator.sender import send_sms_from_outbox
+
+        while True:
+            pks = self._get_pks()
+            try:
+                send_sms_from_outbox(pks)
+            except Exception:  # The thread must not die, not sent SMS are left to the send_sms command
+                LOGGER.exception('Sending SMS from the outbox failed')
+            finally:
+                connection.close()
+
+    def enqueue(self, pk):
+        if config.ATS_OUTBOX_THREAD:
+            self._start_thread()
+            self._queue.put(pk)
+
+    def enqueue_on_commit(self, pk):
+        """
+        Enqueues the SMS once the current transaction is committed, SMS of a rolled back transaction is not sent.
+        """
+        if hasattr(transaction, 'on_commit'):
+            transaction.on_commit(lambda: self.enqueue(pk))
+        else:
+            # Django < 1.9, if the transaction is not committed yet, the SMS is not found and left to send_sms
+            self.enqueue(pk)
+
+
+outbox_sender = OutboxSender(config.ATS_SEND_BATCH_SIZE)
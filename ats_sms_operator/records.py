@@ -0,0 +1,54 @@
+"""
+Compact read-only records of output SMS. The records hold only the columns needed to send the SMS or to check its
+delivery and are loaded from values_list() rows, therefore large batches do not pay for construction of model
+instances. The records implement the same interface as the output SMS model where it is needed (serialize_ats()
+and the columns as attributes).
+"""
+from __future__ import unicode_literals
+
+from chamber.utils import remove_accent
+
+from ats_sms_operator import config
+from ats_sms_operator.xml_utils import escape_attr, escape_text
+
+
+def serialize_ats_sms(pk, sender, recipient, opmid, dlr, validity, kw, billing, content):
+    """
+    Returns ATS elementary request sending SMS with the given column values.
+    """
+    return (
+        '<sms type="text" uniq="{prefix}{uniq}" sender="{sender}" recipient="{recipient}" opmid="{opmid}" '
+        'dlr="{dlr}" validity="{validity}" kw="{kw}"><body order="0" billing="{billing}">{content}</body></sms>'
+    ).format(prefix=escape_attr(config.ATS_UNIQ_PREFIX), uniq=pk, sender=escape_attr(sender),
+             recipient=escape_attr(recipient), opmid=escape_attr(opmid), dlr=int(dlr), validity=validity,
+             kw=escape_attr(kw), billing=int(billing), content=escape_text(remove_accent(content).decode('utf-8')))
+
+
+class Record(object):
+    """
+    Base class of the compact records, `fields` are names of the loaded columns in the order of values_list().
+    """
+
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, *values):
+        for field_name, value in zip(self.fields, values):
+            setattr(self, field_name, value)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.pk)
+
+
+class OutputSMSRecord(Record):
+
+    __slots__ = fields = ('pk', 'sender', 'recipient', 'opmid', 'dlr', 'validity', 'kw', 'billing', 'content')
+
+    def serialize_ats(self):
+        return serialize_ats_sms(self.pk, self.sender, self.recipient, self.opmid, self.dlr, self.validity, self.kw,
+                                 self.billing, self.content)
+
+
+class DeliveryCheckRecord(Record):
+
+    __slots__ = fields = ('pk', 'sent_at', 'created_at', 'validity')
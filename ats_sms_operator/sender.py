@@ -1,33 +1,55 @@
 from __future__ import unicode_literals
 
 import logging
-from itertools import chain
-
-from bs4 import BeautifulSoup
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, deque
+from datetime import timedelta
+from functools import wraps
+from io import BytesIO
+from itertools import chain, islice
+from multiprocessing.pool import ThreadPool
+
+import six
+from six.moves import queue
 
 from django.conf import settings
-from django.db import models
-from django.template import Context, Template
+from django.db import connection, connections, models, router, transaction
+from django.template import Context
 from django.utils import timezone
-from django.utils.encoding import force_text
+from django.utils.encoding import force_bytes, force_text
 from django.utils.translation import ugettext
 
-from chamber.shortcuts import get_object_or_none
-
 from ats_sms_operator import logged_requests as requests
-from ats_sms_operator import config
+from ats_sms_operator import config, metrics
+from ats_sms_operator.circuit_breaker import circuit_breaker
+from ats_sms_operator.outbox import outbox_sender
+from ats_sms_operator.template_cache import get_compiled_sms_template
+from ats_sms_operator.throttling import rate_limiter
+from ats_sms_operator.xml_utils import XMLParseError, escape_attr, escape_text, iter_xml_elements
+
+# Requests raise exceptions of their vendored urllib3 if it is present
+try:
+    from requests.packages.urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+except ImportError:
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
 
 LOGGER = logging.getLogger('ats_sms')
 
-header = """<?xml version="1.0" encoding="UTF-8" ?>
-            <messages>
-                <auth>
-                    <name>{username}</name>
-                    <password>{password}</password>
-                </auth>"""
+header = ('<?xml version="1.0" encoding="UTF-8" ?>'
+          '<messages><auth><name>{username}</name><password>{password}</password></auth>')
 footer = '</messages>'
 
+XML_DECLARATION_RE = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+# Max. number of primary keys used in one "IN" lookup (SQLite does not support more than 999 query parameters)
+MAX_IN_LOOKUP_SIZE = 500
+
 
 class DeliveryRequest(object):
     """
@@ -39,8 +61,9 @@ class DeliveryRequest(object):
         self.output_sms = output_sms
 
     def serialize_ats(self):
-        return """<dlr uniq="{prefix}{pk}">{prefix}{pk}</dlr>""".format(
-            pk=self.output_sms.pk, prefix=config.ATS_UNIQ_PREFIX)
+        return '<dlr uniq="{attr_prefix}{pk}">{text_prefix}{pk}</dlr>'.format(
+            pk=self.output_sms.pk, attr_prefix=escape_attr(config.ATS_UNIQ_PREFIX),
+            text_prefix=escape_text(config.ATS_UNIQ_PREFIX))
 
 
 class ATSSMSException(Exception):
@@ -55,11 +78,15 @@ class SMSValidationError(ATSSMSException):
     pass
 
 
-def serialize_ats_requests(*ats_serializable_objects):
-    """
-    Prepares XML with the given ATS elementary requests. The requests must be an instance of a class implementing
-    the serialize_ats() method.
-    """
+class SMSRateLimitError(SMSSendingError):
+    pass
+
+
+class SMSCircuitOpenError(SMSSendingError):
+    pass
+
+
+def _check_ats_serializable(ats_serializable_objects):
     not_serializable = set(request.__class__.__name__ for request in ats_serializable_objects
                            if not hasattr(request, 'serialize_ats'))
     if not_serializable:
@@ -67,24 +94,165 @@ def serialize_ats_requests(*ats_serializable_objects):
             ugettext('Passed classes do not implement serialize_ats() method: {}').format(not_serializable)
         )
 
-    return ''.join(chain(
-        (header.format(username=config.ATS_USERNAME, password=config.ATS_PASSWORD),),
-        (request.serialize_ats() for request in ats_serializable_objects),
-        (footer,),
-    ))
+
+def _iter_serialized_parts(ats_serializable_objects):
+    yield header.format(username=escape_text(config.ATS_USERNAME), password=escape_text(config.ATS_PASSWORD))
+    for request in ats_serializable_objects:
+        yield request.serialize_ats()
+    yield footer
+
+
+def serialize_ats_requests(*ats_serializable_objects):
+    """
+    Prepares XML with the given ATS elementary requests. The requests must be an instance of a class implementing
+    the serialize_ats() method.
+    """
+    _check_ats_serializable(ats_serializable_objects)
+    with metrics.timer('ats_sms_serialize_seconds'):
+        return ''.join(_iter_serialized_parts(ats_serializable_objects))
+
+
+def iter_serialized_ats_requests(*ats_serializable_objects):
+    """
+    Same as serialize_ats_requests() but returns a generator of UTF-8 encoded chunks of the XML, one chunk per
+    elementary request. The generator can be passed to requests as data of a request sent with chunked encoding.
+    """
+    _check_ats_serializable(ats_serializable_objects)
+    return (part.encode('utf-8') for part in _iter_serialized_parts(ats_serializable_objects))
+
+
+def get_retry_delay(retry):
+    """
+    Returns delay in seconds before the given retry (starting from 1). The delay grows exponentially and it is
+    randomized ("full jitter") so that the retries of more processes are spread in time.
+    """
+    return random.uniform(0, min(config.ATS_RETRY_MAX_DELAY, config.ATS_RETRY_BASE_DELAY * 2 ** (retry - 1)))
+
+
+def is_connect_error(ex):
+    """
+    Returns True if the given requests exception was raised because the connection to ATS was not established.
+    The request was not sent therefore only these requests can be retried without a risk of sending SMS twice.
+    """
+    if isinstance(ex, requests.exceptions.ConnectTimeout):
+        return True
+    elif isinstance(ex, requests.exceptions.ConnectionError) and ex.args:
+        return isinstance(getattr(ex.args[0], 'reason', ex.args[0]), (NewConnectionError, ConnectTimeoutError))
+    else:
+        return False
+
+
+def check_circuit_breaker():
+    """
+    Raises SMSCircuitOpenError if requests to ATS are not allowed because ATS is unavailable.
+    """
+    if not circuit_breaker.allow_request():
+        raise SMSCircuitOpenError(ugettext('ATS is unavailable, requests are not sent until it recovers'))
+
+
+def _get_sms_count(ats_serializable_objects):
+    return len([request for request in ats_serializable_objects if not isinstance(request, DeliveryRequest)])
+
+
+def throttle_ats_requests(*ats_serializable_objects):
+    """
+    Waits until the given ATS requests can be sent without exceeding the per-second rate limit. Raises
+    SMSRateLimitError if the SMS would exceed the daily limit, the SMS should be sent later.
+    """
+    if not rate_limiter.acquire(_get_sms_count(ats_serializable_objects)):
+        raise SMSRateLimitError(ugettext('Daily limit of SMS sent to ATS was exceeded'))
+
+
+def release_ats_requests_budget(*ats_serializable_objects):
+    """
+    Returns the daily budget taken by throttle_ats_requests() for ATS requests that were not accepted by ATS.
+    """
+    rate_limiter.release(_get_sms_count(ats_serializable_objects))
 
 
 def send_ats_requests(*ats_serializable_objects):
     """
     Performs the actual POST request with the given elementary ATS requests.
     """
-    requests_xml = serialize_ats_requests(*ats_serializable_objects)
+    # Streamed request body must be serialized again for every attempt because the stream cannot be reused
+    return _post_ats_requests(ats_serializable_objects, lambda: (
+        iter_serialized_ats_requests(*ats_serializable_objects) if config.ATS_STREAM_REQUESTS
+        else serialize_ats_requests(*ats_serializable_objects)
+    ))
+
+
+def send_serialized_ats_requests(requests_xml, *ats_serializable_objects):
+    """
+    Same as send_ats_requests() but sends the given XML of the elementary ATS requests serialized in advance.
+    """
+    return _post_ats_requests(ats_serializable_objects, lambda: requests_xml)
+
+
+def _post_ats_requests(ats_serializable_objects, get_requests_xml):
+    # The circuit is checked first, requests that are not sent must not take the daily budget
+    check_circuit_breaker()
+    throttle_ats_requests(*ats_serializable_objects)
     logged_requests = [request for request in ats_serializable_objects if isinstance(request, models.Model)]
+    metrics.observe('ats_sms_request_size', len(ats_serializable_objects))
+    requests_xml = get_requests_xml()
+    if isinstance(requests_xml, six.text_type):
+        # The body is encoded once, the same bytes are measured and sent by every attempt
+        requests_xml = requests_xml.encode('utf-8')
+    if isinstance(requests_xml, six.binary_type):
+        metrics.observe('ats_sms_request_bytes', len(requests_xml))
+    retry = 0
+    while True:
+        try:
+            with metrics.timer('ats_sms_request_seconds'):
+                response = requests.post(config.ATS_URL, data=requests_xml, headers={'Content-Type': 'text/xml'},
+                                         slug='ATS SMS', related_objects=logged_requests)
+        except requests.exceptions.RequestException as e:
+            metrics.increment('ats_sms_request_errors_total', error=e.__class__.__name__)
+            # Requests which could have reached ATS (e.g. the connection was aborted) are not retried
+            if is_connect_error(e) and retry < config.ATS_RETRY_MAX_RETRIES:
+                retry += 1
+                LOGGER.warning('ATS request failed, retry {} will be sent: {}'.format(retry, e))
+                time.sleep(get_retry_delay(retry))
+                if not isinstance(requests_xml, six.binary_type):
+                    requests_xml = get_requests_xml()
+                continue
+            circuit_breaker.record_failure()
+            if is_connect_error(e):
+                release_ats_requests_budget(*ats_serializable_objects)
+            raise SMSSendingError(str(e))
+        else:
+            metrics.observe('ats_sms_response_bytes', len(response.content))
+            if response.status_code >= 500:
+                metrics.increment('ats_sms_request_errors_total', error='HTTP{}'.format(response.status_code))
+                circuit_breaker.record_failure()
+                release_ats_requests_budget(*ats_serializable_objects)
+                raise SMSSendingError(ugettext('ATS responded with HTTP status {}').format(response.status_code))
+            circuit_breaker.record_success()
+            return response
+
+
+def strip_uniq_prefix(uniq):
+    """
+    Removes ATS_UNIQ_PREFIX from the beginning of the given uniq.
+    """
+    prefix = config.ATS_UNIQ_PREFIX
+    return uniq[len(prefix):] if prefix and uniq.startswith(prefix) else uniq
+
+
+def iter_response_codes(xml):
+    """
+    Incrementally parses the given ATS response and yields pairs "uniq" -> "response code" for all <code> tags.
+    Uniq is None for codes not related to a particular SMS (errors of the whole request).
+    """
+    if isinstance(xml, six.text_type):
+        # The text is already decoded therefore the encoding declaration must not be used by the parser
+        xml = XML_DECLARATION_RE.sub('', xml, count=1).encode('utf-8')
     try:
-        return requests.post(config.ATS_URL, data=requests_xml, headers={'Content-Type': 'text/xml'},
-                             slug='ATS SMS', related_objects=logged_requests)
-    except requests.exceptions.RequestException as e:
-        raise SMSSendingError(str(e))
+        for code in iter_xml_elements(BytesIO(xml.lstrip()), 'code'):
+            uniq = code.get('uniq')
+            yield (int(strip_uniq_prefix(uniq)) if uniq else None, int(code.text))
+    except (XMLParseError, TypeError, ValueError) as ex:
+        raise SMSSendingError(ugettext('ATS response cannot be parsed: {}').format(force_text(ex)))
 
 
 def parse_response_codes(xml):
@@ -92,18 +260,26 @@ def parse_response_codes(xml):
     Finds all <code> tags in the given XML and returns a mapping "uniq" -> "response code" for all SMS.
     In case of an error, the error is logged.
     """
-    soup = BeautifulSoup(xml, 'html.parser')
-    code_tags = soup.find_all('code')
-
-    LOGGER.warning(', '.join(
-        [(force_text(config.ATS_STATES.get_label(c))
-          if c in config.ATS_STATES.all
-          else 'ATS returned an unknown state {}.'.format(c))
-         for c in [int(error_code.string) for error_code in code_tags if not error_code.attrs.get('uniq')]],
-    ))
-
-    return {int(code.attrs['uniq'].lstrip(config.ATS_UNIQ_PREFIX)): int(code.string)
-            for code in code_tags if code.attrs.get('uniq')}
+    response_codes = {}
+    error_codes = []
+    with metrics.timer('ats_sms_parse_seconds'):
+        for uniq, code in iter_response_codes(xml):
+            if uniq is None:
+                error_codes.append(code)
+            else:
+                response_codes[uniq] = code
+
+    for code, count in Counter(chain(response_codes.values(), error_codes)).items():
+        metrics.increment('ats_sms_response_codes_total', count, code=code)
+
+    if error_codes:
+        LOGGER.warning(', '.join(
+            [(force_text(config.ATS_STATES.get_label(c))
+              if c in config.ATS_STATES.all
+              else 'ATS returned an unknown state {}.'.format(c))
+             for c in error_codes],
+        ))
+    return response_codes
 
 
 def send_and_parse_response(*ats_requests):
@@ -113,19 +289,59 @@ def send_and_parse_response(*ats_requests):
     return parse_response_codes(send_ats_requests(*ats_requests).text)
 
 
+def chunks(sequence, size):
+    """
+    Splits the given sequence to lists of the given size.
+    """
+    sequence = list(sequence)
+    return [sequence[i:i + size] for i in range(0, len(sequence), size)]
+
+
+def iter_chunks(iterable, size):
+    """
+    Lazy variant of chunks(), yields lists of the given size read from the iterable. Only one list is kept
+    in memory at a time.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def update_sms_states(parsed_response):
     """
     Higher-level function performing serialization of ATS requests, parsing ATS server response and updating
-    SMS messages state according the received response.
-    """
-    for uniq, state in parsed_response.items():
-        sms = get_object_or_none(config.get_output_sms_model(), pk=uniq)
-        if sms:
-            sms.state = state if state in config.ATS_STATES.all else config.ATS_STATES.LOCAL_UNKNOWN_ATS_STATE
-            sms.sent_at = timezone.now()
-            sms.save()
-        else:
-            raise SMSValidationError(ugettext('SMS with uniq "{}" not found in DB.').format(uniq))
+    SMS messages state according the received response. SMS are updated in bulk, one UPDATE query per resulting
+    state. Time of sending is set only to SMS that were not sent yet (responses to delivery requests do not change
+    it). Uniqs not found in DB are reported together after all found SMS were updated.
+    """
+    sms_model = config.get_output_sms_model()
+    with metrics.timer('ats_sms_update_states_seconds'):
+        existing_pks = set(chain.from_iterable(
+            sms_model.objects.filter(pk__in=uniqs).values_list('pk', flat=True)
+            for uniqs in chunks(parsed_response.keys(), MAX_IN_LOOKUP_SIZE)
+        ))
+
+        pks_by_state = {}
+        for uniq, state in parsed_response.items():
+            if uniq in existing_pks:
+                state = state if state in config.ATS_STATES.all else config.ATS_STATES.LOCAL_UNKNOWN_ATS_STATE
+                pks_by_state.setdefault(state, []).append(uniq)
+
+        now = timezone.now()
+        with transaction.atomic():
+            for state, pks in pks_by_state.items():
+                for pks_chunk in chunks(pks, MAX_IN_LOOKUP_SIZE):
+                    sms_model.objects.filter(pk__in=pks_chunk).update(state=state, changed_at=now)
+            for pks_chunk in chunks(existing_pks, MAX_IN_LOOKUP_SIZE):
+                sms_model.objects.filter(pk__in=pks_chunk, sent_at__isnull=True).update(sent_at=now)
+
+    missing_uniqs = sorted(set(parsed_response.keys()) - existing_pks)
+    if missing_uniqs:
+        raise SMSValidationError(ugettext('SMS with uniqs "{}" not found in DB.').format(
+            ', '.join(map(force_text, missing_uniqs))))
 
 
 def update_sms_state_from_response(output_sms, parsed_response):
@@ -144,33 +360,650 @@ def send_and_update_sms_states(*ats_requests):
     update_sms_states(send_and_parse_response(*ats_requests))
 
 
-def send_template(recipient, slug='', context=None, **sms_attrs):
+def iter_batches(queryset, batch_size=None, record_class=None, sizer=None):
     """
-    Use this function to send an SMS template to a given number.
+    Walks the given queryset in chunks ordered by the primary key and yields every chunk as a list of at most
+    `batch_size` objects. Every chunk is fetched by a separate query starting after the last primary key of
+    the previous chunk, therefore only one chunk is kept in memory at a time. If `record_class` is set, only its
+    fields are loaded and the chunks contain its instances (compact records) instead of model instances.
+    If `sizer` (e.g. AdaptiveBatchSizer) is set, size of every chunk is given by its current batch_size.
     """
-    context = context or {}
+    queryset = queryset.order_by('pk')
+    if record_class is not None:
+        queryset = queryset.values_list(*record_class.fields)
+    last_pk = None
+    while True:
+        batch_size = sizer.batch_size if sizer is not None else batch_size or config.ATS_SEND_BATCH_SIZE
+        batch = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:batch_size])
+        if record_class is not None:
+            batch = [record_class(*values) for values in batch]
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last_pk = batch[-1].pk
+
+
+def filter_shard(queryset, shard, shards):
+    """
+    Returns part of the given queryset with objects whose primary key modulo `shards` equals `shard`. Processes
+    handling different shards of the same queryset process disjoint objects without any coordination. The condition
+    is evaluated on rows found by the other (indexed) conditions of the queryset.
+    """
+    if shards <= 1:
+        return queryset
+    ops = connections[queryset.db].ops
+    pk_column = '{}.{}'.format(ops.quote_name(queryset.model._meta.db_table),
+                               ops.quote_name(queryset.model._meta.pk.column))
+    return queryset.extra(where=['{} %% %s = %s'.format(pk_column)], params=[shards, shard])
+
+
+def get_recipient_shard(recipient, shards):
+    """
+    Returns shard of the given recipient, all SMS for one recipient belong to the same shard.
+    """
+    return (zlib.crc32(force_bytes(recipient)) & 0xffffffff) % shards
+
+
+def filter_recipient_shard(batches, shard, shards):
+    """
+    Filters SMS of the given batches to SMS whose recipient belongs to the given shard. A process handling a shard
+    sends SMS for its recipients in the order of their primary keys. Empty batches are skipped.
+    """
+    for batch in batches:
+        batch = [output_sms for output_sms in batch if get_recipient_shard(output_sms.recipient, shards) == shard]
+        if batch:
+            yield batch
+
+
+def _send_and_parse_measured_response(*ats_requests, **kwargs):
+    """
+    Same as send_and_parse_response() but returns the parsed response together with duration of the ATS request
+    in seconds and size of the request body in bytes (None if the body was streamed). XML of the requests
+    serialized in advance can be passed as `requests_xml`.
+    """
+    requests_xml = kwargs.get('requests_xml')
+    response = (send_ats_requests(*ats_requests) if requests_xml is None
+                else send_serialized_ats_requests(requests_xml, *ats_requests))
+    body = response.request.body
+    # Body is sent encoded, streamed body (a generator) cannot be measured
+    body_size = len(body) if isinstance(body, six.binary_type) else None
+    return parse_response_codes(response.text), response.elapsed.total_seconds(), body_size
+
+
+def _record_sent_batch(sizer, batch, measured_response):
+    if sizer is not None:
+        sizer.record_success(len(batch), *measured_response[1:])
+    return measured_response[0]
+
+
+def _update_sent_batch_states(batch, parsed_response, on_failure):
+    """
+    Updates states of SMS of the sent batch. SMS whose status code is missing in the ATS response (e.g. ATS
+    returned only an error of the whole request) were not accepted, they are handled as a failed batch. Returns
+    the number of failed batches (0 or 1).
+    """
+    update_sms_states(parsed_response)
+    not_accepted = [output_sms for output_sms in batch if output_sms.pk not in parsed_response]
+    if not_accepted:
+        _handle_failed_batch(not_accepted, SMSSendingError(
+            ugettext('ATS response misses status codes of {} SMS').format(len(not_accepted))), on_failure)
+        return 1
+    return 0
+
+
+def _handle_failed_batch(batch, ex, on_failure, sizer=None):
+    """
+    Logs the failed batch and passes it to `on_failure`. Returns True if the sending should be stopped because
+    no other batch can be sent now (the rate limit is exceeded or the circuit breaker is open).
+    """
+    stop_sending = isinstance(ex, (SMSCircuitOpenError, SMSRateLimitError))
+    if sizer is not None and isinstance(ex, SMSSendingError) and not stop_sending:
+        # Requests that were not sent do not say anything about the batch size
+        sizer.record_failure(len(batch))
+    LOGGER.error(ugettext('Sending batch of {count} ATS requests failed: {error}').format(
+        count=len(batch), error=force_text(ex)))
+    if on_failure is not None:
+        on_failure(batch, ex)
+    return stop_sending
+
+
+def fit_batches_to_day_budget(batches):
+    """
+    Splits batches larger than the remaining daily budget of SMS so that the part fitting into the budget is sent.
+    The rest of the batch follows as a separate batch (refused by the rate limiter if the budget is used up).
+    """
+    for batch in batches:
+        remaining = rate_limiter.get_remaining_day_budget()
+        if remaining and remaining < _get_sms_count(batch):
+            yield batch[:remaining]
+            batch = batch[remaining:]
+        yield batch
+
+
+def send_and_update_sms_states_in_batches(batches, workers=None, on_failure=None, sizer=None, pipelined=False,
+                                          queue_size=None):
+    """
+    Sends every batch of ATS requests in a separate ATS request and updates the corresponding SMS states. Every
+    batch is committed on its own, a failed batch is logged (and passed to `on_failure` callable together with
+    the exception) and does not prevent the other batches from being sent. Only if the rate limit is exceeded or
+    the circuit breaker is open, the remaining batches are not sent (nor fetched). Batches larger than
+    the remaining daily budget of SMS are split so that the budget is used up.
+    With more than one worker, up to `workers` ATS requests are in flight at once. Only the HTTP requests and
+    parsing of the responses run in the worker threads, SMS states are updated in the calling thread.
+    In the pipelined mode, the calling thread fetches and serializes the next batches and applies states of the
+    sent batches while `workers` transport threads send the serialized batches. At most `queue_size` serialized
+    batches wait for a transport thread, the fetching is blocked when the queue is full.
+    Durations of the ATS requests and failures are recorded to `sizer` (the same sizer should be passed to
+    iter_batches() generating the batches). Returns the number of batches that failed.
+    """
+    workers = workers or config.ATS_SEND_WORKERS
+    batches = fit_batches_to_day_budget(batches)
+    if pipelined:
+        return SendingPipeline(workers, queue_size or config.ATS_SEND_PIPELINE_QUEUE_SIZE, on_failure, sizer).run(
+            batches)
+    elif workers > 1:
+        return _send_and_update_sms_states_in_parallel(batches, workers, on_failure, sizer)
+
+    failed = 0
+    for batch in batches:
+        try:
+            failed += _update_sent_batch_states(
+                batch, _record_sent_batch(sizer, batch, _send_and_parse_measured_response(*batch)), on_failure)
+        except ATSSMSException as ex:
+            failed += 1
+            if _handle_failed_batch(batch, ex, on_failure, sizer):
+                break
+    return failed
+
+
+def _send_and_parse_response_in_worker(*ats_requests):
     try:
-        sms_template = config.get_sms_template_model().objects.get(slug=slug)
-        output_sms = config.get_output_sms_model().objects.create(
-            recipient=recipient,
-            template_slug=slug,
-            content=Template(sms_template.body).render(Context(context)),
-            state=(config.ATS_STATES.DEBUG if settings.ATS_SMS_DEBUG and recipient not in config.ATS_WHITELIST
-                   else config.ATS_STATES.PROCESSING),
-            **sms_attrs
-        )
-        if not settings.ATS_SMS_DEBUG or recipient in config.ATS_WHITELIST:
-            parsed_response = send_and_parse_response(output_sms)
-            update_sms_state_from_response(output_sms, parsed_response)
-            output_sms.save()
-        return output_sms
+        return _send_and_parse_measured_response(*ats_requests)
+    finally:
+        # Logging of the request may open a DB connection in the worker thread
+        connection.close()
+
+
+def _send_and_update_sms_states_in_parallel(batches, workers, on_failure, sizer):
+    pool = ThreadPool(workers)
+    in_flight = deque()
+    failed = 0
+
+    def update_states_of_first_batch():
+        """
+        Returns the number of failed batches (0 or 1) and whether the sending should be stopped.
+        """
+        batch, result = in_flight.popleft()
+        try:
+            return _update_sent_batch_states(batch, _record_sent_batch(sizer, batch, result.get()), on_failure), False
+        except ATSSMSException as ex:
+            return 1, _handle_failed_batch(batch, ex, on_failure, sizer)
+
+    try:
+        for batch in batches:
+            in_flight.append((batch, pool.apply_async(_send_and_parse_response_in_worker, batch)))
+            if len(in_flight) >= workers:
+                batch_failed, stop_sending = update_states_of_first_batch()
+                failed += batch_failed
+                if stop_sending:
+                    break
+        while in_flight:
+            failed += update_states_of_first_batch()[0]
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+class SendingPipeline(object):
+    """
+    Sends batches of ATS requests by transport threads while the calling thread fetches and serializes the next
+    batches and applies the results. All DB queries are performed by the calling thread. When the batches are
+    exhausted (or an exception is raised) the transport threads are stopped after the already queued batches are
+    sent and their results are applied.
+    """
+
+    STOP = object()
+
+    def __init__(self, workers, queue_size, on_failure=None, sizer=None):
+        self.workers = workers
+        self.on_failure = on_failure
+        self.sizer = sizer
+        self.send_queue = queue.Queue(queue_size)
+        self.result_queue = queue.Queue()
+        self.pending = 0
+        self.failed = 0
+        self.stopped = False
+
+    def _send_batches(self):
+        try:
+            while True:
+                item = self.send_queue.get()
+                if item is self.STOP:
+                    return
+                batch, requests_xml = item
+                try:
+                    self.result_queue.put((batch, _send_and_parse_measured_response(*batch, requests_xml=requests_xml),
+                                           None))
+                except Exception as ex:
+                    self.result_queue.put((batch, None, ex))
+        finally:
+            # Logging of the request may open a DB connection in the transport thread
+            connection.close()
+
+    def _fail_batch(self, batch, ex):
+        self.failed += 1
+        if _handle_failed_batch(batch, ex, self.on_failure, self.sizer):
+            self.stopped = True
+
+    def _apply_result(self, block):
+        batch, measured_response, ex = self.result_queue.get(block)
+        self.pending -= 1
+        if ex is None:
+            try:
+                self.failed += _update_sent_batch_states(
+                    batch, _record_sent_batch(self.sizer, batch, measured_response), self.on_failure)
+            except ATSSMSException as update_ex:
+                self._fail_batch(batch, update_ex)
+        elif isinstance(ex, ATSSMSException):
+            self._fail_batch(batch, ex)
+        else:
+            raise ex
+
+    def _apply_available_results(self):
+        try:
+            while True:
+                self._apply_result(block=False)
+        except queue.Empty:
+            pass
+
+    def _submit(self, batch):
+        try:
+            item = (batch, serialize_ats_requests(*batch).encode('utf-8'))
+        except ATSSMSException as ex:
+            self._fail_batch(batch, ex)
+            return
+
+        self.pending += 1
+        while True:
+            try:
+                self.send_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                # Results are applied while the transport threads are busy
+                self._apply_available_results()
+
+    def run(self, batches):
+        threads = [threading.Thread(target=self._send_batches) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for batch in batches:
+                self._submit(batch)
+                self._apply_available_results()
+                if self.stopped:
+                    break
+        finally:
+            for _ in threads:
+                self.send_queue.put(self.STOP)
+            while self.pending:
+                self._apply_result(block=True)
+            for thread in threads:
+                thread.join()
+        return self.failed
+
+
+def get_dlr_check_interval(output_sms, now):
+    """
+    Returns time to wait before the next delivery check of the given SMS. The interval doubles with the age of
+    the SMS (SMS is checked when it is approx. 1, 2, 4, 8... minimal intervals old) up to the maximal interval.
+    """
+    min_interval = timedelta(seconds=config.ATS_DLR_MIN_CHECK_INTERVAL)
+    interval = min_interval
+    while interval * 2 <= now - (output_sms.sent_at or output_sms.created_at):
+        interval *= 2
+    return min(interval, timedelta(seconds=config.ATS_DLR_MAX_CHECK_INTERVAL))
+
+
+def is_dlr_check_expired(output_sms, now):
+    """
+    Returns True if the validity of the SMS (and the grace period) elapsed, its state will not change anymore.
+    """
+    return ((output_sms.sent_at or output_sms.created_at) + timedelta(minutes=output_sms.validity) +
+            timedelta(seconds=config.ATS_DLR_GRACE_PERIOD) < now)
+
+
+def check_sms_delivery_states(output_sms_list):
+    """
+    Sends delivery requests for the given SMS in one ATS request and updates their states. SMS with elapsed validity
+    are not checked anymore and are moved to the TIMEOUT state. Time of the next check of the other SMS is planned
+    with exponential backoff according to their age. SMS can be model instances or DeliveryCheckRecord instances.
+    """
+    sms_model = config.get_output_sms_model()
+    now = timezone.now()
+    expired_sms_list = [output_sms for output_sms in output_sms_list if is_dlr_check_expired(output_sms, now)]
+    checked_sms_list = [output_sms for output_sms in output_sms_list if not is_dlr_check_expired(output_sms, now)]
+
+    for pks in chunks((output_sms.pk for output_sms in expired_sms_list), MAX_IN_LOOKUP_SIZE):
+        sms_model.objects.filter(pk__in=pks).update(state=config.ATS_STATES.TIMEOUT, changed_at=now)
+
+    if checked_sms_list:
+        send_and_update_sms_states(*[DeliveryRequest(output_sms) for output_sms in checked_sms_list])
+
+        pks_by_interval = {}
+        for output_sms in checked_sms_list:
+            pks_by_interval.setdefault(get_dlr_check_interval(output_sms, now), []).append(output_sms.pk)
+        for interval, pks in pks_by_interval.items():
+            for pks_chunk in chunks(pks, MAX_IN_LOOKUP_SIZE):
+                sms_model.objects.filter(pk__in=pks_chunk).update(next_dlr_check_at=now + interval)
+
+
+def is_sent_to_ats(recipient):
+    """
+    Returns True if SMS for the given recipient should be sent to ATS, in debug mode only whitelisted
+    recipients receive the SMS.
+    """
+    return not settings.ATS_SMS_DEBUG or recipient in config.ATS_WHITELIST
+
+
+def get_compiled_sms_template_or_raise(slug, recipient):
+    try:
+        return get_compiled_sms_template(slug)
     except config.get_sms_template_model().DoesNotExist:
         LOGGER.error(ugettext('SMS message template with slug {slug} does not exist. '
                               'The message to {recipient} cannot be sent.').format(recipient=recipient, slug=slug))
-        output_sms.state = config.ATS_STATES.LOCAL_ERROR
-        output_sms.save()
         raise SMSSendingError(ugettext('SMS message template with slug {} does not exist').format(slug))
-    except SMSSendingError:
-        output_sms.state = config.ATS_STATES.LOCAL_TO_SEND
+
+
+_sms_batches = threading.local()
+
+
+class SMSBatch(object):
+    """
+    Collects SMS created by send_template() inside the block and sends them together in one ATS request
+    (or in batches of ATS_SEND_BATCH_SIZE SMS) when the block exits. If the block is inside a transaction
+    (or `on_commit` is set), the SMS are sent once the transaction is committed (not at all if it is rolled back).
+    On Django < 1.9, which cannot run code after commit, SMS of a block with `on_commit` set are left
+    in the outbox instead. SMS of a block that raised an exception are not sent but left in the outbox. States
+    of the SMS are updated in DB only, SMS returned by send_template() stay in the PROCESSING state. SMS that
+    failed to be sent are logged and returned to the outbox (LOCAL_TO_SEND). Nested blocks join the outermost one.
+    Can be used as a context manager or a decorator.
+    """
+
+    def __init__(self, on_commit=False):
+        self.on_commit = on_commit
+        self.output_sms_list = None
+
+    def __enter__(self):
+        if getattr(_sms_batches, 'current', None) is None:
+            self.output_sms_list = _sms_batches.current = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.output_sms_list is not None:
+            _sms_batches.current = None
+            if self.output_sms_list:
+                using = router.db_for_write(config.get_output_sms_model())
+                in_transaction = transaction.get_connection(using).in_atomic_block
+                if exc_type is not None and in_transaction and hasattr(transaction, 'on_commit'):
+                    # SMS are dropped by rollback, if the exception is handled and the transaction committed,
+                    # the SMS are left in the outbox
+                    transaction.on_commit(self.return_to_outbox, using=using)
+                elif exc_type is not None:
+                    if not transaction.get_connection(using).needs_rollback:
+                        self.return_to_outbox()
+                elif (self.on_commit or in_transaction) and hasattr(transaction, 'on_commit'):
+                    transaction.on_commit(self.send, using=using)
+                elif self.on_commit:
+                    self.return_to_outbox()
+                else:
+                    self.send()
+
+    def __call__(self, func):
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            with self.__class__(self.on_commit):
+                return func(*args, **kwargs)
+        return decorated
+
+    def send(self):
+        try:
+            send_and_update_sms_states_in_batches(chunks(self.output_sms_list, config.ATS_SEND_BATCH_SIZE),
+                                                  on_failure=mark_sms_to_send)
+        finally:
+            return_processing_sms_to_outbox([output_sms.pk for output_sms in self.output_sms_list])
+
+    def return_to_outbox(self):
+        mark_sms_to_send(self.output_sms_list)
+        for output_sms in self.output_sms_list:
+            outbox_sender.enqueue_on_commit(output_sms.pk)
+
+
+def sms_batch(on_commit=False):
+    """
+    Returns SMSBatch coalescing SMS sent by send_template() inside the block to one ATS request:
+
+        with sms_batch():
+            send_template(user_number, 'notification')
+            for watcher_number in watcher_numbers:
+                send_template(watcher_number, 'watcher-notification')
+    """
+    return SMSBatch(on_commit)
+
+
+def send_template(recipient, slug='', context=None, deferred=None, **sms_attrs):
+    """
+    Use this function to send an SMS template to a given number. Deferred SMS (by default according to
+    ATS_SEND_DEFERRED) is only stored to the outbox and sent by a background thread after the current transaction
+    is committed. SMS sent inside sms_batch() block is sent together with the other SMS of the block.
+    """
+    context = context or {}
+    deferred = config.ATS_SEND_DEFERRED if deferred is None else deferred
+    template = get_compiled_sms_template_or_raise(slug, recipient)
+    if not is_sent_to_ats(recipient):
+        state = config.ATS_STATES.DEBUG
+    elif deferred:
+        state = config.ATS_STATES.LOCAL_TO_SEND
+    else:
+        state = config.ATS_STATES.PROCESSING
+
+    output_sms = config.get_output_sms_model().objects.create(
+        recipient=recipient,
+        template_slug=slug,
+        content=template.render(Context(context)),
+        state=state,
+        **sms_attrs
+    )
+    current_sms_batch = getattr(_sms_batches, 'current', None)
+    if state == config.ATS_STATES.LOCAL_TO_SEND:
+        outbox_sender.enqueue_on_commit(output_sms.pk)
+    elif state == config.ATS_STATES.PROCESSING and current_sms_batch is not None:
+        current_sms_batch.append(output_sms)
+    elif state == config.ATS_STATES.PROCESSING:
+        try:
+            parsed_response = send_and_parse_response(output_sms)
+            update_sms_state_from_response(output_sms, parsed_response)
+        except SMSSendingError:
+            output_sms.state = config.ATS_STATES.LOCAL_TO_SEND
+            output_sms.save()
+            raise
         output_sms.save()
-        raise
+    return output_sms
+
+
+def mark_sms_to_send(output_sms_list, ex=None):
+    """
+    Returns the given SMS to the outbox (LOCAL_TO_SEND state) to be sent later. Can be used as on_failure callback
+    of send_and_update_sms_states_in_batches().
+    """
+    for pks in chunks((output_sms.pk for output_sms in output_sms_list), MAX_IN_LOOKUP_SIZE):
+        config.get_output_sms_model().objects.filter(pk__in=pks).update(state=config.ATS_STATES.LOCAL_TO_SEND,
+                                                                        changed_at=timezone.now())
+
+
+def _claim_pks(pks):
+    """
+    Moves SMS with the given pks from the LOCAL_TO_SEND state to PROCESSING and returns pks of the moved SMS.
+    Rows are locked with SELECT ... FOR UPDATE SKIP LOCKED if the database supports it. Otherwise every chunk
+    of SMS is moved by one conditional UPDATE setting a claim token unique for the call and the moved SMS are
+    found by the token. One SMS therefore cannot be claimed by two processes.
+    """
+    sms_model = config.get_output_sms_model()
+    if getattr(connections[router.db_for_write(sms_model)].features, 'has_select_for_update_skip_locked', False):
+        claimed_pks = []
+        for pks_chunk in chunks(pks, MAX_IN_LOOKUP_SIZE):
+            with transaction.atomic():
+                locked_pks = list(sms_model.objects.filter(
+                    pk__in=pks_chunk, state=config.ATS_STATES.LOCAL_TO_SEND
+                ).select_for_update(skip_locked=True).values_list('pk', flat=True))
+                sms_model.objects.filter(pk__in=locked_pks).update(state=config.ATS_STATES.PROCESSING,
+                                                                   changed_at=timezone.now())
+            claimed_pks += locked_pks
+        return claimed_pks
+    else:
+        claim_token = uuid.uuid4().hex
+        claimed_pks = []
+        for pks_chunk in chunks(pks, MAX_IN_LOOKUP_SIZE):
+            if sms_model.objects.filter(pk__in=pks_chunk, state=config.ATS_STATES.LOCAL_TO_SEND).update(
+                    state=config.ATS_STATES.PROCESSING, claim_token=claim_token, changed_at=timezone.now()):
+                claimed_pks += list(sms_model.objects.filter(
+                    pk__in=pks_chunk, claim_token=claim_token
+                ).order_by('pk').values_list('pk', flat=True))
+        return claimed_pks
+
+
+def claim_sms_to_send(pks):
+    """
+    Moves SMS with the given pks from the LOCAL_TO_SEND state to PROCESSING and returns the moved SMS. One SMS
+    cannot be claimed by two processes.
+    """
+    sms_model = config.get_output_sms_model()
+    return [output_sms for pks_chunk in chunks(_claim_pks(pks), MAX_IN_LOOKUP_SIZE)
+            for output_sms in sms_model.objects.filter(pk__in=pks_chunk).order_by('pk')]
+
+
+def claim_batches(batches, claimed_pks=None):
+    """
+    Claims SMS of the given batches (moves them from LOCAL_TO_SEND to PROCESSING) right before the batch is sent
+    and yields batches of the claimed SMS only. SMS that were claimed by somebody else in the meantime (e.g. by
+    the outbox thread) are skipped, therefore they are not sent twice. Empty batches are skipped. SMS of a failed
+    batch should be returned to the outbox by mark_sms_to_send(). Pks of the claimed SMS are appended
+    to the `claimed_pks` list if it is given.
+    """
+    for batch in batches:
+        batch_claimed_pks = set(_claim_pks([output_sms.pk for output_sms in batch]))
+        batch = [output_sms for output_sms in batch if output_sms.pk in batch_claimed_pks]
+        if claimed_pks is not None:
+            claimed_pks.extend(output_sms.pk for output_sms in batch)
+        if batch:
+            yield batch
+
+
+def return_processing_sms_to_outbox(pks):
+    """
+    Returns SMS with the given pks that are still in the PROCESSING state (their sending was not finished,
+    e.g. because of an unexpected error or because the sending was stopped by the rate limit) to the outbox.
+    """
+    for pks_chunk in chunks(pks, MAX_IN_LOOKUP_SIZE):
+        config.get_output_sms_model().objects.filter(pk__in=pks_chunk, state=config.ATS_STATES.PROCESSING).update(
+            state=config.ATS_STATES.LOCAL_TO_SEND, changed_at=timezone.now())
+
+
+def claim_sms_batch(queryset, batch_size=None):
+    """
+    Claims at most `batch_size` SMS in the LOCAL_TO_SEND state from the given queryset (moves them to PROCESSING)
+    and returns them. Rows are locked with SELECT ... FOR UPDATE SKIP LOCKED if the database supports it, so
+    concurrent workers claim different SMS. Otherwise the SMS are claimed by a conditional UPDATE with a claim
+    token, if a concurrent worker claimed some of the selected SMS first, the next SMS are selected and claimed.
+    """
+    batch_size = batch_size or config.ATS_SEND_BATCH_SIZE
+    sms_model = config.get_output_sms_model()
+    queryset = queryset.filter(state=config.ATS_STATES.LOCAL_TO_SEND).order_by('pk')
+    if getattr(connections[router.db_for_write(sms_model)].features, 'has_select_for_update_skip_locked', False):
+        with transaction.atomic():
+            pks = list(queryset.select_for_update(skip_locked=True).values_list('pk', flat=True)[:batch_size])
+            sms_model.objects.filter(pk__in=pks).update(state=config.ATS_STATES.PROCESSING, changed_at=timezone.now())
+        return list(sms_model.objects.filter(pk__in=pks).order_by('pk'))
+    else:
+        claimed_pks = []
+        while len(claimed_pks) < batch_size:
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size - len(claimed_pks)])
+            if not pks:
+                break
+            claimed_pks += _claim_pks(pks)
+        return [output_sms for pks_chunk in chunks(claimed_pks, MAX_IN_LOOKUP_SIZE)
+                for output_sms in sms_model.objects.filter(pk__in=pks_chunk).order_by('pk')]
+
+
+def send_sms_from_outbox(pks):
+    """
+    Claims and sends SMS with the given pks that are still in the outbox, SMS of a failed batch are returned back.
+    """
+    claimed_sms_list = claim_sms_to_send(pks)
+    try:
+        send_and_update_sms_states_in_batches(chunks(claimed_sms_list, config.ATS_SEND_BATCH_SIZE),
+                                              on_failure=mark_sms_to_send)
+    finally:
+        return_processing_sms_to_outbox([output_sms.pk for output_sms in claimed_sms_list])
+
+
+def bulk_create_output_sms(output_sms_list):
+    """
+    Saves the given new output SMS and returns them. If the database returns primary keys of rows inserted in bulk,
+    the SMS are inserted by bulk_create, without calling save() (the SMS are cleaned before, the same as in save()).
+    Otherwise the SMS are saved one by one in one transaction.
+    """
+    sms_model = config.get_output_sms_model()
+    features = connections[router.db_for_write(sms_model)].features
+    if getattr(features, 'can_return_rows_from_bulk_insert',
+               getattr(features, 'can_return_ids_from_bulk_insert', False)):
+        for output_sms in output_sms_list:
+            output_sms._pre_save(False)
+            output_sms.full_clean()
+        return sms_model.objects.bulk_create(output_sms_list)
+    else:
+        with transaction.atomic():
+            for output_sms in output_sms_list:
+                output_sms.save()
+        return output_sms_list
+
+
+def send_template_bulk(slug, recipients, **sms_attrs):
+    """
+    Use this function to send an SMS template to many numbers at once. Recipients are phone numbers or pairs
+    (phone number, context). All SMS are created in bulk and sent to ATS in batches of ATS_SEND_BATCH_SIZE SMS,
+    SMS of a batch that failed to be sent are left in the LOCAL_TO_SEND state. Returns list of the created SMS,
+    states of the SMS updated according to ATS responses are not refreshed in the returned instances.
+    """
+    recipients = list(recipients)
+    template = get_compiled_sms_template_or_raise(slug, ugettext('{} recipients').format(len(recipients)))
+    sms_model = config.get_output_sms_model()
+
+    output_sms_list = []
+    for recipient in recipients:
+        recipient, context = (recipient, None) if isinstance(recipient, six.string_types) else recipient
+        output_sms_list.append(sms_model(
+            recipient=recipient,
+            template_slug=slug,
+            content=template.render(Context(context or {})),
+            state=config.ATS_STATES.PROCESSING if is_sent_to_ats(recipient) else config.ATS_STATES.DEBUG,
+            **sms_attrs
+        ))
+    output_sms_list = bulk_create_output_sms(output_sms_list)
+
+    processing_sms_list = [output_sms for output_sms in output_sms_list
+                           if output_sms.state == config.ATS_STATES.PROCESSING]
+    try:
+        send_and_update_sms_states_in_batches(chunks(processing_sms_list, config.ATS_SEND_BATCH_SIZE),
+                                              on_failure=mark_sms_to_send)
+    finally:
+        return_processing_sms_to_outbox([output_sms.pk for output_sms in processing_sms_list])
+    return output_sms_list
+
+
+if six.PY3:
+    from ats_sms_operator.async_sender import (async_send_and_parse_response, async_send_and_update_sms_states,  # noqa
+                                               async_send_ats_requests, async_send_template, close_client_session)
@@ -0,0 +1,262 @@
+"""
+Offline simulator of the ATS gateway for load testing and development. The simulator speaks the same XML protocol
+as ATS: it accepts <messages> with <sms> and <dlr> requests and answers with <status> containing one <code> per
+request. Latency of responses, error codes, dropped connections and progression of delivery states can be
+configured. The simulator can also push MO (input) messages to the URL of InputATSSMSmessageResource.
+
+The simulator can be run by the run_ats_simulator command or used as a context manager in code:
+
+    with ATSSimulator(latency=parse_latency('uniform:0.01,0.1'), error_codes={334: 0.01}) as simulator:
+        # send SMS to simulator.url
+"""
+from __future__ import unicode_literals
+
+import random
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+
+import requests
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from ats_sms_operator.config import ATS_STATES
+from ats_sms_operator.xml_utils import XMLParseError, escape_attr, escape_text, iter_xml_elements
+
+
+REQUEST_TAGS = ('sms', 'dlr')
+
+# Codes that are returned for the whole request instead of a particular SMS
+REQUEST_ERROR_CODES = (ATS_STATES.AUTHENTICATION_FAILED, ATS_STATES.DB_ERROR, ATS_STATES.XML_MISSING,
+                       ATS_STATES.XML_UNREADABLE, ATS_STATES.WRONG_HTTP_METHOD, ATS_STATES.XML_INVALID)
+
+
+def parse_latency(spec):
+    """
+    Returns function generating latency in seconds from its textual specification. Supported specifications are
+    "constant:<seconds>", "uniform:<min>,<max>", "exponential:<mean>" and "lognormal:<mu>,<sigma>".
+    """
+    name, _, params = spec.partition(':')
+    params = [float(param) for param in params.split(',') if param]
+    distributions = {
+        'constant': lambda rand, seconds: seconds,
+        'uniform': lambda rand, low, high: rand.uniform(low, high),
+        'exponential': lambda rand, mean: rand.expovariate(1.0 / mean) if mean else 0,
+        'lognormal': lambda rand, mu, sigma: rand.lognormvariate(mu, sigma),
+    }
+    if name not in distributions:
+        raise ValueError('Unknown latency distribution "{}"'.format(name))
+    return lambda rand: distributions[name](rand, *params)
+
+
+def parse_error_codes(specs):
+    """
+    Returns mapping "code" -> "probability" from the textual specifications "<code>:<probability>".
+    """
+    return {int(code): float(probability) for code, probability in (spec.split(':') for spec in specs)}
+
+
+def read_request_body(request_handler):
+    """
+    Reads body of the request, both requests with Content-Length and requests sent with chunked encoding
+    are supported.
+    """
+    if request_handler.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            chunk_size = int(request_handler.rfile.readline().split(b';')[0].strip(), 16)
+            if not chunk_size:
+                request_handler.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(request_handler.rfile.read(chunk_size))
+            request_handler.rfile.readline()
+    else:
+        return request_handler.rfile.read(int(request_handler.headers.get('Content-Length') or 0))
+
+
+class ATSSimulatorRequestHandler(BaseHTTPRequestHandler):
+
+    # Connections are kept alive the same as by ATS
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        simulator = self.server.simulator
+        body = read_request_body(self)
+        time.sleep(simulator.get_latency())
+        if simulator.should_drop_connection():
+            # The connection is closed without any response
+            self.close_connection = True
+            return
+
+        response = simulator.process_request(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class ATSSimulatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ATSSimulator(object):
+    """
+    Simulated ATS gateway. Every accepted SMS is reported by delivery requests as NOT_SENT until `dlr_sent_after`
+    seconds elapse, then as SENT until `dlr_delivered_after` seconds elapse and finally as DELIVERED (or
+    NOT_DELIVERED with probability `undelivered_rate`). Unknown SMS are reported as NOT_FOUND.
+
+    `error_codes` is a mapping "code" -> "probability". Request error codes (e.g. 705 XML invalid) fail the whole
+    request, other codes (e.g. 334 daily limit) are returned for single SMS. `drop_rate` is a probability that
+    the connection is closed without a response.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, error_codes=None, drop_rate=0, dlr_sent_after=0,
+                 dlr_delivered_after=0, undelivered_rate=0, mo_url=None, mo_interval=1, mo_batch_size=10,
+                 seed=None):
+        self.address = (host, port)
+        self.latency = latency
+        self.error_codes = error_codes or {}
+        self.drop_rate = drop_rate
+        self.dlr_sent_after = dlr_sent_after
+        self.dlr_delivered_after = dlr_delivered_after
+        self.undelivered_rate = undelivered_rate
+        self.mo_url = mo_url
+        self.mo_interval = mo_interval
+        self.mo_batch_size = mo_batch_size
+        self.random = random.Random(seed)
+        self.accepted_sms = {}
+        self.stats = {'requests': 0, 'sms': 0, 'dlr': 0, 'dropped': 0, 'mo': 0}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = None
+        self._threads = []
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self._server.server_address[:2])
+
+    def get_latency(self):
+        return max(0, self.latency(self.random)) if self.latency else 0
+
+    def should_drop_connection(self):
+        dropped = self.random.random() < self.drop_rate
+        if dropped:
+            with self._lock:
+                self.stats['dropped'] += 1
+        return dropped
+
+    def _get_injected_error_code(self, request_error):
+        for code, probability in self.error_codes.items():
+            if (code in REQUEST_ERROR_CODES) == request_error and self.random.random() < probability:
+                return code
+        return None
+
+    def _get_delivery_state(self, uniq, now):
+        accepted_at = self.accepted_sms.get(uniq)
+        if accepted_at is None:
+            return ATS_STATES.NOT_FOUND
+        elif now - accepted_at < self.dlr_sent_after:
+            return ATS_STATES.NOT_SENT
+        elif now - accepted_at < self.dlr_delivered_after:
+            return ATS_STATES.SENT
+        elif random.Random(uniq).random() < self.undelivered_rate:
+            # The final state of the SMS must not change between delivery requests
+            return ATS_STATES.NOT_DELIVERED
+        else:
+            return ATS_STATES.DELIVERED
+
+    def _format_code(self, code, uniq=None):
+        if uniq is None:
+            return '<code>{}</code>'.format(code)
+        else:
+            return '<code uniq="{}">{}</code>'.format(escape_attr(uniq), code)
+
+    def process_request(self, body):
+        """
+        Returns XML response to the given XML request body.
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+        request_error_code = self._get_injected_error_code(request_error=True)
+        codes = []
+        if request_error_code is not None:
+            codes.append(self._format_code(request_error_code))
+        elif not body.strip():
+            codes.append(self._format_code(ATS_STATES.XML_MISSING))
+        else:
+            try:
+                requests_list = [(element.tag, element.get('uniq') or (element.text or '').strip())
+                                 for element in iter_xml_elements(BytesIO(body), REQUEST_TAGS)]
+            except XMLParseError:
+                codes.append(self._format_code(ATS_STATES.XML_UNREADABLE))
+            else:
+                now = time.time()
+                with self._lock:
+                    for tag, uniq in requests_list:
+                        self.stats[tag] += 1
+                        if tag == 'sms':
+                            code = self._get_injected_error_code(request_error=False)
+                            if code is None:
+                                code = ATS_STATES.OK
+                                self.accepted_sms[uniq] = now
+                        else:
+                            code = self._get_delivery_state(uniq, now)
+                        codes.append(self._format_code(code, uniq))
+        return '<?xml version="1.0" encoding="UTF-8" ?><status>{}</status>'.format(''.join(codes))
+
+    def build_mo_messages(self, count):
+        """
+        Returns XML payload with the given number of random MO messages in the format sent by ATS.
+        """
+        ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        messages = []
+        with self._lock:
+            for _ in range(count):
+                self.stats['mo'] += 1
+                uniq = self.random.randint(1, 2 ** 31 - 1)
+                messages.append(
+                    '<sms uniq="{uniq}" sender="+420{sender}" recipient="9001103" okey="SIM" opid="simulator" '
+                    'opmid="" ts="{ts}">{content}</sms>'.format(
+                        uniq=uniq, sender=self.random.randint(600000000, 799999999), ts=ts,
+                        content=escape_text('Simulated message {}'.format(uniq)))
+                )
+        return '<?xml version="1.0" encoding="UTF-8" ?><messages>{}</messages>'.format(''.join(messages))
+
+    def _push_mo_messages(self):
+        while not self._stopped.wait(self.mo_interval):
+            try:
+                requests.post(self.mo_url, data=self.build_mo_messages(self.mo_batch_size).encode('utf-8'),
+                              headers={'Content-Type': 'text/xml'}, timeout=10)
+            except requests.exceptions.RequestException:
+                pass
+
+    def start(self):
+        self._stopped.clear()
+        self._server = ATSSimulatorServer(self.address, ATSSimulatorRequestHandler)
+        self._server.simulator = self
+        self._threads = [threading.Thread(target=self._server.serve_forever)]
+        if self.mo_url:
+            self._threads.append(threading.Thread(target=self._push_mo_messages))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,88 @@
+from __future__ import unicode_literals
+
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.template import Template
+
+from ats_sms_operator import config
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:
+    from django.core.cache import get_cache
+
+
+class SMSTemplateCache(object):
+    """
+    In-process LRU cache of compiled SMS templates keyed by slug. The whole cache is invalidated whenever an SMS
+    template is saved or deleted. If a shared cache backend is set, the invalidation is propagated to other processes
+    by changing a version stored in the shared cache.
+    """
+
+    VERSION_CACHE_KEY = 'ats_sms_operator:sms_template_version'
+
+    def __init__(self, max_size, shared_cache_alias=None):
+        self.max_size = max_size
+        self.shared_cache_alias = shared_cache_alias
+        self._templates = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _get_shared_cache(self):
+        return get_cache(self.shared_cache_alias) if self.shared_cache_alias else None
+
+    def _get_version(self):
+        shared_cache = self._get_shared_cache()
+        if shared_cache is None:
+            return self._generation, None
+
+        shared_version = shared_cache.get(self.VERSION_CACHE_KEY)
+        if shared_version is None:
+            shared_cache.add(self.VERSION_CACHE_KEY, uuid.uuid4().hex)
+            shared_version = shared_cache.get(self.VERSION_CACHE_KEY)
+        return self._generation, shared_version
+
+    def get(self, slug):
+        """
+        Returns compiled template of the SMS template with the given slug. Raises DoesNotExist of the SMS template
+        model if the template does not exist.
+        """
+        if not self.max_size:
+            return Template(config.get_sms_template_model().objects.get(slug=slug).body)
+
+        version = self._get_version()
+        with self._lock:
+            cached = self._templates.pop(slug, None)
+            if cached is not None and cached[0] == version:
+                self._templates[slug] = cached
+                return cached[1]
+
+        template = Template(config.get_sms_template_model().objects.get(slug=slug).body)
+        with self._lock:
+            # Template could be changed while it was being loaded, then it must not be cached
+            if version[0] == self._generation:
+                self._templates[slug] = (version, template)
+                while len(self._templates) > self.max_size:
+                    self._templates.popitem(last=False)
+        return template
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._templates.clear()
+
+        shared_cache = self._get_shared_cache()
+        if shared_cache is not None:
+            shared_cache.set(self.VERSION_CACHE_KEY, uuid.uuid4().hex)
+
+
+sms_template_cache = SMSTemplateCache(config.ATS_SMS_TEMPLATE_CACHE_SIZE, config.ATS_SMS_TEMPLATE_CACHE_BACKEND)
+
+
+def get_compiled_sms_template(slug):
+    return sms_template_cache.get(slug)
@@ -0,0 +1,89 @@
+from __future__ import unicode_literals
+
+import time
+from datetime import datetime
+
+from ats_sms_operator import config
+from ats_sms_operator.template_cache import get_cache
+
+
+class RateLimiter(object):
+    """
+    Limits number of SMS sent to ATS per second and per day. Counters are stored in a Django cache, if the cache
+    is shared (memcached, redis, database cache...) the limits are shared by all processes using it. The per-second
+    limit works as a token bucket with capacity `per_second` refilled every second.
+    """
+
+    KEY_PREFIX = 'ats_sms_operator:rate_limit'
+
+    def __init__(self, per_second=None, per_day=None, cache_alias='default'):
+        self.per_second = per_second
+        self.per_day = per_day
+        self.cache_alias = cache_alias
+
+    def _incr(self, cache, key, delta, timeout):
+        cache.add(key, 0, timeout)
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            # Key expired in the meantime
+            cache.add(key, 0, timeout)
+            return cache.incr(key, delta)
+
+    def _get_day_key(self):
+        return '{}:day:{}'.format(self.KEY_PREFIX, datetime.now().strftime('%Y%m%d'))
+
+    def _acquire_day_budget(self, cache, count):
+        key = self._get_day_key()
+        if self._incr(cache, key, count, 2 * 24 * 60 * 60) > self.per_day:
+            cache.decr(key, count)
+            return False
+        return True
+
+    def _acquire_second_budget(self, cache, count):
+        while count > 0:
+            now = time.time()
+            key = '{}:second:{}'.format(self.KEY_PREFIX, int(now))
+            requested = min(count, self.per_second)
+            used = self._incr(cache, key, requested, 10)
+            count -= max(0, min(requested, self.per_second - (used - requested)))
+            if count > 0:
+                time.sleep(int(now) + 1 - now)
+
+    def acquire(self, count):
+        """
+        Waits until `count` SMS can be sent without exceeding the per-second limit. Returns False without waiting
+        if sending the SMS would exceed the daily limit.
+        """
+        if not count or (not self.per_second and not self.per_day):
+            return True
+
+        cache = get_cache(self.cache_alias)
+        if self.per_day and not self._acquire_day_budget(cache, count):
+            return False
+        if self.per_second:
+            self._acquire_second_budget(cache, count)
+        return True
+
+    def get_remaining_day_budget(self):
+        """
+        Returns number of SMS that can still be sent today or None if there is no daily limit.
+        """
+        if not self.per_day:
+            return None
+        return max(0, self.per_day - (get_cache(self.cache_alias).get(self._get_day_key()) or 0))
+
+    def release(self, count):
+        """
+        Returns `count` SMS to the daily budget, it should be called if the acquired SMS were not accepted by ATS.
+        """
+        if count and self.per_day:
+            try:
+                get_cache(self.cache_alias).decr(self._get_day_key(), count)
+            except ValueError:
+                # The budget of the day has already expired
+                pass
+
+
+rate_limiter = RateLimiter(config.ATS_RATE_LIMIT_PER_SECOND, config.ATS_RATE_LIMIT_PER_DAY,
+                           config.ATS_RATE_LIMIT_CACHE_BACKEND)
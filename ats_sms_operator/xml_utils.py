@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+
+from xml.sax.saxutils import escape
+
+from django.utils.encoding import force_text
+
+try:
+    from lxml.etree import ParseError as XMLParseError, iterparse
+    ITERPARSE_KWARGS = {'resolve_entities': False, 'no_network': True}
+except ImportError:
+    try:
+        from xml.etree.cElementTree import ParseError as XMLParseError, iterparse
+    except ImportError:
+        from xml.etree.ElementTree import ParseError as XMLParseError, iterparse
+    ITERPARSE_KWARGS = {}
+
+
+def escape_text(value):
+    """
+    Escapes the given value to be used as a text content of an XML element.
+    """
+    return escape(force_text(value))
+
+
+def escape_attr(value):
+    """
+    Escapes the given value to be used as a double-quoted XML attribute value.
+    """
+    return escape(force_text(value), {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'})
+
+
+def iter_xml_elements(source, tag):
+    """
+    Incrementally parses XML from the given file-like object and yields every element with the given tag (or one of
+    the given tuple of tags) as soon as it is complete. Processed elements are removed from the tree, therefore memory
+    does not grow with the size of the document. Raises XMLParseError if the XML is not well-formed.
+    """
+    tags = tag if isinstance(tag, tuple) else (tag,)
+    root = None
+    for event, element in iterparse(source, events=('start', 'end'), **ITERPARSE_KWARGS):
+        if root is None:
+            root = element
+        elif event == 'end' and element.tag in tags:
+            yield element
+            root.clear()
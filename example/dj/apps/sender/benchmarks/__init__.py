@@ -0,0 +1,55 @@
+from __future__ import unicode_literals
+
+import gc
+import time
+
+from django.db import transaction
+
+
+class Rollback(Exception):
+    pass
+
+
+def measure(func, repeat=5):
+    """
+    Calls the given function `repeat` times and returns the best and the average duration in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    return {'best': min(durations), 'average': sum(durations) / len(durations), 'repeat': repeat}
+
+
+def measure_rolled_back(func, setup=None, repeat=5):
+    """
+    Same as measure() but every call of the function is performed in a transaction which is rolled back afterwards,
+    therefore the benchmark does not change the database. Optional `setup` function is called in the transaction
+    before the measured function and its duration is not measured.
+    """
+    durations = []
+    for _ in range(repeat):
+        try:
+            with transaction.atomic():
+                if setup:
+                    setup()
+                durations.append(measure(func, repeat=1)['best'])
+                raise Rollback
+        except Rollback:
+            pass
+    return {'best': min(durations), 'average': sum(durations) / len(durations), 'repeat': repeat}
+
+
+def get_benchmarks():
+    """
+    Returns list of all benchmark functions. Every benchmark function returns an iterable of result dictionaries.
+    """
+    from .commands import benchmark_check_sms_delivery_command, benchmark_send_sms_command
+    from .ingestion import benchmark_input_sms_ingestion
+    from .parsing import benchmark_parse_input_messages, benchmark_parse_response_codes
+    from .serialization import benchmark_serialize_ats_requests
+
+    return [benchmark_serialize_ats_requests, benchmark_parse_response_codes, benchmark_parse_input_messages,
+            benchmark_input_sms_ingestion, benchmark_send_sms_command, benchmark_check_sms_delivery_command]
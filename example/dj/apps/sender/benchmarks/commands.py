@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+
+from django.db.models import Max
+from django.utils import timezone
+
+from ats_sms_operator import config
+from ats_sms_operator.config import ATS_STATES
+from ats_sms_operator.management.commands.check_sms_delivery import Command as CheckDeliveryCommand
+from ats_sms_operator.management.commands.send_sms import Command as SendCommand
+from ats_sms_operator.simulator import ATSSimulator
+
+from sender.models import OutputSMS
+
+from . import measure_rolled_back
+from .serialization import build_output_sms_list
+
+
+SMS_COUNTS = (100, 1000, 10000)
+
+SEND_SMS_OPTIONS = (
+    {'compact': False},
+    {'compact': True},
+    {'compact': True, 'pipelined': True, 'workers': 2},
+)
+
+
+@contextmanager
+def ats_simulator(**simulator_kwargs):
+    """
+    Runs ATS simulator on a local port and sends all ATS requests to it.
+    """
+    with ATSSimulator(**simulator_kwargs) as simulator:
+        ats_url = config.ATS_URL
+        config.ATS_URL = simulator.url
+        try:
+            yield simulator
+        finally:
+            config.ATS_URL = ats_url
+
+
+def create_output_sms(count, **sms_attrs):
+    output_sms_list = build_output_sms_list(count, (OutputSMS.objects.aggregate(max_pk=Max('pk'))['max_pk'] or 0) + 1)
+    for output_sms in output_sms_list:
+        for name, value in sms_attrs.items():
+            setattr(output_sms, name, value)
+    OutputSMS.objects.bulk_create(output_sms_list)
+
+
+def benchmark_command(name, command, options, **sms_attrs):
+    with ats_simulator():
+        for count in SMS_COUNTS:
+            result = measure_rolled_back(lambda: command.handle(**options),
+                                         lambda: create_output_sms(count, **sms_attrs), repeat=3)
+            result.update(options)
+            result.update({'benchmark': name, 'messages': count,
+                           'messages_per_second': count / result['best'] if result['best'] else None})
+            yield result
+
+
+def benchmark_send_sms_command():
+    for options in SEND_SMS_OPTIONS:
+        for result in benchmark_command('send_sms_command', SendCommand(), options, state=ATS_STATES.LOCAL_TO_SEND):
+            yield result
+
+
+def benchmark_check_sms_delivery_command():
+    return benchmark_command('check_sms_delivery_command', CheckDeliveryCommand(), {}, state=ATS_STATES.OK,
+                             dlr=True, sent_at=timezone.now())
@@ -0,0 +1,29 @@
+from __future__ import unicode_literals
+
+from django.test import Client
+
+from . import measure_rolled_back
+from .parsing import build_input_payload
+
+
+INPUT_PAYLOAD_SIZES = (1000, 10000, 100000)
+
+INPUT_SMS_URLS = (
+    ('per_message', '/api/atsinputsmsmessage/'),
+    ('bulk', '/api/atsinputsmsmessage/bulk/'),
+)
+
+
+def benchmark_input_sms_ingestion():
+    """
+    Measures whole processing of input SMS payloads by InputATSSMSmessageResource, created input SMS are rolled back.
+    """
+    client = Client()
+    for size in INPUT_PAYLOAD_SIZES:
+        body = build_input_payload(size)
+        for name, url in INPUT_SMS_URLS:
+            result = measure_rolled_back(lambda: client.post(url, data=body, content_type='text/xml'),
+                                         repeat=3 if size < 100000 else 1)
+            result.update({'benchmark': 'input_sms_ingestion', 'mode': name, 'messages': size,
+                           'messages_per_second': size / result['best'] if result['best'] else None})
+            yield result
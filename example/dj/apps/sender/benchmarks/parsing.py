@@ -0,0 +1,72 @@
+from __future__ import unicode_literals
+
+from io import BytesIO
+
+from bs4 import BeautifulSoup
+
+from django.utils.encoding import force_text
+
+from ats_sms_operator import config
+from ats_sms_operator.cores.resources import iter_input_messages, merge
+from ats_sms_operator.sender import parse_response_codes
+
+from . import measure
+
+
+RESPONSE_SIZES = (100, 1000, 10000)
+INPUT_PAYLOAD_SIZES = (100, 1000, 10000)
+
+
+def build_response(size):
+    return '\n'.join(
+        ['<?xml version="1.0" encoding="UTF-8" ?>', '<status>'] +
+        ['<code uniq="{}{}">{}</code>'.format(config.ATS_UNIQ_PREFIX, uniq, uniq % 3) for uniq in range(size)] +
+        ['</status>']
+    )
+
+
+def parse_response_codes_with_beautifulsoup(xml):
+    """
+    The former implementation of parse_response_codes() (without logging) kept for comparison.
+    """
+    soup = BeautifulSoup(xml, 'html.parser')
+    return {int(code.attrs['uniq'][len(config.ATS_UNIQ_PREFIX):]): int(code.string)
+            for code in soup.find_all('code') if code.attrs.get('uniq')}
+
+
+def benchmark_parse_response_codes():
+    for size in RESPONSE_SIZES:
+        xml = build_response(size)
+        for name, parser in (('iterparse', parse_response_codes),
+                             ('beautifulsoup', parse_response_codes_with_beautifulsoup)):
+            result = measure(lambda: parser(xml))
+            result.update({'benchmark': 'parse_response_codes', 'parser': name, 'codes': size})
+            yield result
+
+
+def build_input_payload(size):
+    return '\n'.join(
+        ['<?xml version="1.0" encoding="UTF-8" ?>', '<messages>'] +
+        ['<sms uniq="{}" sender="+420731545945" recipient="9001103" okey="T2" opid="tmsms" opmid="" '
+         'ts="2006-04-10 09:32:18">message {}</sms>'.format(uniq, uniq) for uniq in range(size)] +
+        ['</messages>']
+    ).encode('utf-8')
+
+
+def parse_input_messages_with_beautifulsoup(body):
+    """
+    The former implementation of InputATSSMSmessageResource._deserialize() kept for comparison.
+    """
+    soup = BeautifulSoup(force_text(body), 'html.parser')
+    return ([merge(msg.attrs, {'content': msg.string or ''}) for msg in soup.messages.find_all('sms')]
+            if soup.messages else ())
+
+
+def benchmark_parse_input_messages():
+    for size in INPUT_PAYLOAD_SIZES:
+        body = build_input_payload(size)
+        for name, parser in (('iterparse', lambda: list(iter_input_messages(BytesIO(body)))),
+                             ('beautifulsoup', lambda: parse_input_messages_with_beautifulsoup(body))):
+            result = measure(parser)
+            result.update({'benchmark': 'parse_input_messages', 'parser': name, 'messages': size})
+            yield result
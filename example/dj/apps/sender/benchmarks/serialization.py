@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+from ats_sms_operator.sender import serialize_ats_requests
+
+from sender.models import OutputSMS
+
+from . import measure
+
+
+BATCH_SIZES = (1, 10, 100, 1000, 10000)
+
+
+def build_output_sms_list(size, start_pk=1):
+    """
+    Returns list of unsaved output SMS with primary keys set, ready to be serialized.
+    """
+    return [OutputSMS(pk=pk, sender='+420777123456', recipient='+420777111222', kw='BENCHMARK',
+                      content='Benchmark SMS number {}'.format(pk))
+            for pk in range(start_pk, start_pk + size)]
+
+
+def benchmark_serialize_ats_requests():
+    for size in BATCH_SIZES:
+        output_sms_list = build_output_sms_list(size)
+        result = measure(lambda: serialize_ats_requests(*output_sms_list))
+        result.update({'benchmark': 'serialize_ats_requests', 'batch_size': size,
+                       'messages_per_second': size / result['best'] if result['best'] else None})
+        yield result
@@ -0,0 +1,16 @@
+from __future__ import unicode_literals
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from sender.benchmarks import get_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Runs the performance benchmarks and prints one JSON object per result line.'
+
+    def handle(self, *args, **options):
+        for benchmark in get_benchmarks():
+            for result in benchmark():
+                self.stdout.write(json.dumps(result, sort_keys=True))
@@ -1,2 +1,7 @@
+import six
+
 from .inputsms import *
 from .outputsms import *
+
+if six.PY3:
+    from .asyncsms import *
@@ -0,0 +1,131 @@
+"""
+Tests of the asyncio sender, imported on Python 3 only.
+"""
+import asyncio
+from unittest import skipIf
+
+import requests
+import responses
+
+from django.conf import settings
+from django.test import TransactionTestCase
+
+from germanium.tools import assert_equal, assert_false, assert_raises, assert_true
+
+from ats_sms_operator import config
+from ats_sms_operator.async_sender import (aiohttp, async_send_and_update_sms_states, async_send_template,
+                                           close_client_session, get_client_session)
+from ats_sms_operator.config import ATS_STATES
+from ats_sms_operator.sender import SMSSendingError, send_sms_from_outbox
+from ats_sms_operator.simulator import ATSSimulator
+
+from sender.models import OutputSMS
+
+from .models.factories import OutputSMSFactory, SMSTemplateFactory
+from .outputsms import ok_response_callback
+
+
+def run_in_event_loop(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(close_client_session())
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+class AsyncOutputSMSTestCase(TransactionTestCase):
+    """
+    ORM queries of the async sender run in other threads, therefore the tests cannot run inside a test transaction.
+    Requests sent by aiohttp are not mocked by responses, they are sent to ATSSimulator.
+    """
+
+    def setUp(self):
+        super(AsyncOutputSMSTestCase, self).setUp()
+        SMSTemplateFactory()
+        self.ats_url, self.use_aiohttp = config.ATS_URL, config.ATS_ASYNC_USE_AIOHTTP
+        self.outbox_thread = config.ATS_OUTBOX_THREAD
+
+    def tearDown(self):
+        config.ATS_URL, config.ATS_ASYNC_USE_AIOHTTP = self.ats_url, self.use_aiohttp
+        config.ATS_OUTBOX_THREAD = self.outbox_thread
+        config.ATS_RETRY_MAX_RETRIES, config.ATS_RETRY_BASE_DELAY = 0, 0.5
+        super(AsyncOutputSMSTestCase, self).tearDown()
+
+    @responses.activate
+    def test_async_sms_template_should_be_sent_through_requests(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=ok_response_callback)
+        config.ATS_ASYNC_USE_AIOHTTP = False
+
+        sms = run_in_event_loop(async_send_template('+420777111222', slug='test'))
+
+        assert_equal(len(responses.calls), 1)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @responses.activate
+    def test_async_sms_template_for_unavailable_service_should_be_left_to_send(self):
+        def raise_exception(request):
+            raise requests.exceptions.ConnectionError()
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=raise_exception)
+        config.ATS_ASYNC_USE_AIOHTTP = False
+
+        assert_raises(SMSSendingError, run_in_event_loop, async_send_template('+420777111222', slug='test', pk=260))
+        assert_equal(OutputSMS.objects.get(pk=260).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @responses.activate
+    def test_deferred_async_sms_template_should_be_sent_from_outbox(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=ok_response_callback)
+        config.ATS_OUTBOX_THREAD = False  # The SMS is left in the outbox
+
+        sms = run_in_event_loop(async_send_template('+420777111222', slug='test', deferred=True))
+
+        assert_equal(len(responses.calls), 0)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.LOCAL_TO_SEND)
+        send_sms_from_outbox([sms.pk])
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_sms_template_should_be_sent_through_aiohttp(self):
+        with ATSSimulator() as simulator:
+            config.ATS_URL = simulator.url
+            sms = run_in_event_loop(async_send_template('+420777111222', slug='test'))
+            assert_equal(simulator.stats['sms'], 1)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_sms_template_for_dropped_connection_should_be_left_to_send(self):
+        config.ATS_RETRY_MAX_RETRIES, config.ATS_RETRY_BASE_DELAY = 2, 0
+        with ATSSimulator(drop_rate=1) as simulator:
+            config.ATS_URL = simulator.url
+            assert_raises(SMSSendingError, run_in_event_loop,
+                          async_send_template('+420777111222', slug='test', pk=261))
+            assert_equal(simulator.stats['requests'], 1)  # Request that could reach ATS is not retried
+        assert_equal(OutputSMS.objects.get(pk=261).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_sms_states_should_be_updated(self):
+        sms_list = [OutputSMSFactory(state=ATS_STATES.PROCESSING) for _ in range(3)]
+        with ATSSimulator() as simulator:
+            config.ATS_URL = simulator.url
+            run_in_event_loop(async_send_and_update_sms_states(*sms_list))
+        for sms in sms_list:
+            assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_client_session_should_be_closed(self):
+        async def get_and_close_session():
+            session = get_client_session()
+            assert_false(session.closed)
+            await close_client_session()
+            return session
+
+        loop = asyncio.new_event_loop()
+        try:
+            assert_true(loop.run_until_complete(get_and_close_session()).closed)
+        finally:
+            loop.close()
@@ -3,6 +3,8 @@ from __future__ import unicode_literals
 from germanium.rest import RESTTestCase
 from germanium.tools import assert_equal
 
+from ats_sms_operator.sender import MAX_IN_LOOKUP_SIZE
+
 from sender.models import InputSMS
 
 
@@ -47,3 +49,33 @@ class InputSMSTestCase(RESTTestCase):
                      '<?xml version="1.0" encoding="UTF-8" ?> <status> <code uniq="">24</code> '
                      '<code uniq="invalid">24</code> <code uniq="4">24</code> '
                      '<code uniq="5">23</code> </status>')
+
+    def test_repeated_ats_request_should_not_create_input_sms_again(self):
+        self.post(self.API_URL, self.ATS_SMS_POST_PAYLOAD.format(self.VALID_MESSAGES))
+        sms_count = InputSMS.objects.count()
+        response = self.post(self.API_URL, self.ATS_SMS_POST_PAYLOAD.format(self.VALID_MESSAGES))
+        self.assert_http_ok(response)
+        assert_equal(sms_count, InputSMS.objects.count())
+        assert_equal(response.content.replace('\n', ' ').replace('\r', ''),
+                     '<?xml version="1.0" encoding="UTF-8" ?> <status> <code uniq="2">23</code> '
+                     '<code uniq="3">23</code> <code uniq="4">23</code> </status>')
+
+    def test_ats_malformed_request_should_return_200(self):
+        response = self.post(self.API_URL, self.ATS_SMS_POST_PAYLOAD.format(self.VALID_MESSAGES + '<sms uniq="5">'))
+        self.assert_http_ok(response)  # ATS requires to return 200 in every situation
+
+
+class BulkInputSMSTestCase(InputSMSTestCase):
+
+    API_URL = '/api/atsinputsmsmessage/bulk/'
+
+    def test_ats_request_larger_than_chunk_should_create_input_sms_once(self):
+        message = ('<sms uniq="{}" sender="+420731545945" recipient="9001103" okey="T2" opid="tmsms" opmid="" '
+                   'ts="2006-04-10 09:32:18">test</sms>')
+        uniqs = list(range(1, MAX_IN_LOOKUP_SIZE + 2)) + [1]  # The last message is in the next chunk
+        sms_count = InputSMS.objects.count()
+        response = self.post(self.API_URL, self.ATS_SMS_POST_PAYLOAD.format(
+            ''.join(message.format(uniq) for uniq in uniqs)))
+        self.assert_http_ok(response)
+        assert_equal(sms_count + MAX_IN_LOOKUP_SIZE + 1, InputSMS.objects.count())
+        assert_equal(response.content.count('>23</code>'), len(uniqs))
@@ -1,34 +1,66 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import re
+import signal
+import time
+from unittest import skipIf, skipUnless
 from datetime import timedelta
+from itertools import chain
 
 import requests
 import responses
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
 
 from django.conf import settings
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
+from django.utils.encoding import force_text
 
 from germanium.anotations import data_provider, turn_off_auto_now
 from germanium.tools import assert_equal, assert_false, assert_is_not_none, assert_raises, assert_true
 
-from ats_sms_operator.config import ATS_STATES
+from ats_sms_operator import config, logged_requests
+from ats_sms_operator.batching import AdaptiveBatchSizer
+from ats_sms_operator.circuit_breaker import CircuitBreaker, circuit_breaker
+from ats_sms_operator.metrics import PrometheusMetricsBackend
+from ats_sms_operator.records import OutputSMSRecord
+from ats_sms_operator.config import ATS_HTTP_POOL_SIZE, ATS_PROCESSING_TIMEOUT, ATS_STATES
 from ats_sms_operator.management.commands.check_sms_delivery import Command as CheckDeliveryCommand
 from ats_sms_operator.management.commands.clean_processing_sms import Command as CleanProcessingCommand
+from ats_sms_operator.management.commands.run_sms_worker import Command as WorkerCommand
 from ats_sms_operator.management.commands.send_sms import Command as SendCommand
-from ats_sms_operator.sender import (SMSSendingError, SMSValidationError, parse_response_codes,
-                                     send_and_update_sms_states, send_ats_requests, send_template,
-                                     serialize_ats_requests)
+from ats_sms_operator.sender import (DeliveryRequest, SMSCircuitOpenError, SMSRateLimitError, SMSSendingError,
+                                     SMSValidationError, claim_batches, claim_sms_batch, claim_sms_to_send,
+                                     get_recipient_shard, iter_batches, iter_serialized_ats_requests, mark_sms_to_send,
+                                     parse_response_codes, send_and_parse_response, send_and_update_sms_states,
+                                     send_and_update_sms_states_in_batches, send_ats_requests, send_sms_from_outbox,
+                                     send_template, send_template_bulk, serialize_ats_requests, sms_batch,
+                                     strip_uniq_prefix, update_sms_states)
+from ats_sms_operator.simulator import ATSSimulator
+from ats_sms_operator.template_cache import sms_template_cache
+from ats_sms_operator.throttling import RateLimiter, rate_limiter
 
-from sender.models import OutputSMS
+from sender.models import OutputSMS, SMSTemplate
 
 from .models.factories import OutputSMSFactory, SMSTemplateFactory
 
 
 # TODO remove this when the function is added to chamber
 def strip_all(txt):
-    return ''.join(txt.split())
+    return ''.join(force_text(txt).split())
+
+
+def ok_response_callback(request):
+    request_body = force_text(request.body)
+    return (200, {}, ''.join(chain(
+        ('<?xml version="1.0" encoding="UTF-8" ?><status>',),
+        ('<code uniq="{}">0</code>'.format(uniq) for uniq in re.findall(r'<sms [^>]*uniq="([^"]+)"', request_body)),
+        ('</status>',)
+    )))
 
 
 class OutputSMSTestCase(TestCase):
@@ -130,6 +162,26 @@ class OutputSMSTestCase(TestCase):
                      strip_all(self.ATS_SMS_REQUEST.format(prefix=settings.ATS_UNIQ_PREFIX, uniq1=sms1.pk,
                                                            uniq2=sms2.pk)))
 
+    def test_should_escape_serialized_sms_message(self):
+        sms = OutputSMSFactory(content='a < b & "c"', opmid='"x"<y>', **{k: v for k, v in self.ATS_OUTPUT_SMS1.items()
+                                                                         if k != 'content'})
+        serialized_sms = sms.serialize_ats()
+        assert_true('<body order="0" billing="0">a &lt; b &amp; "c"</body>' in serialized_sms)
+        assert_true('opmid="&quot;x&quot;&lt;y&gt;"' in serialized_sms)
+
+    def test_compact_record_should_be_serialized_the_same_as_sms_message(self):
+        sms = OutputSMSFactory(**self.ATS_OUTPUT_SMS1)
+        records = list(iter_batches(OutputSMS.objects.all(), record_class=OutputSMSRecord))[0]
+        assert_equal(len(records), 1)
+        assert_equal(records[0].serialize_ats(), sms.serialize_ats())
+
+    def test_should_serialize_ats_requests_to_stream_of_chunks(self):
+        sms1 = OutputSMSFactory(**self.ATS_OUTPUT_SMS1)
+        sms2 = OutputSMSFactory(**self.ATS_OUTPUT_SMS2)
+        chunks = list(iter_serialized_ats_requests(sms1, sms2))
+        assert_equal(len(chunks), 4)
+        assert_equal(b''.join(chunks), serialize_ats_requests(sms1, sms2).encode('utf-8'))
+
     def get_prefixes(self):
         return ('',), (settings.ATS_UNIQ_PREFIX,)
 
@@ -151,6 +203,15 @@ class OutputSMSTestCase(TestCase):
         assert_equal(response_codes[self.ATS_TEST_UNIQ['uniq1']], 0)
         assert_equal(response_codes[self.ATS_TEST_UNIQ['uniq2']], 123456)
 
+    def test_parse_response_codes_should_strip_only_uniq_prefix(self):
+        prefix = settings.ATS_UNIQ_PREFIX
+        assert_equal(strip_uniq_prefix('{}245'.format(prefix)), '245')
+        assert_equal(strip_uniq_prefix('{0}{0}245'.format(prefix)), '{}245'.format(prefix))
+        assert_equal(strip_uniq_prefix('245'), '245')
+
+    def test_parse_response_codes_should_raise_exception_for_invalid_xml(self):
+        assert_raises(SMSSendingError, parse_response_codes, '<html><body>Bad Gateway</body>')
+
     @responses.activate
     def test_parsing_response_should_raise_exception_if_uniq_does_not_exist(self):
         def raise_exception(request):
@@ -163,6 +224,11 @@ class OutputSMSTestCase(TestCase):
 
         assert_raises(SMSSendingError, send_and_update_sms_states, sms1, sms2)
 
+    def test_ats_requests_should_share_one_pooled_session(self):
+        session = logged_requests.get_session()
+        assert_true(session is logged_requests.get_session())
+        assert_equal(session.get_adapter(settings.ATS_URL)._pool_maxsize, ATS_HTTP_POOL_SIZE)
+
     @responses.activate
     def test_requests_exception_should_be_caught_and_raised(self):
         responses.add(responses.POST, settings.ATS_URL, content_type='text/xml', status=200,
@@ -173,8 +239,26 @@ class OutputSMSTestCase(TestCase):
 
         assert_raises(SMSValidationError, send_and_update_sms_states, sms1, sms2)
 
+    def test_update_sms_states_should_update_found_sms_and_report_missing_uniqs_together(self):
+        sms1 = OutputSMSFactory(pk=self.ATS_TEST_UNIQ['uniq1'], **self.ATS_OUTPUT_SMS1)
+        sms2 = OutputSMSFactory(pk=self.ATS_TEST_UNIQ['uniq2'], **self.ATS_OUTPUT_SMS2)
+
+        with assert_raises(SMSValidationError) as ex:
+            update_sms_states({sms1.pk: ATS_STATES.OK, -5: ATS_STATES.OK, sms2.pk: 123456, -6: ATS_STATES.OK})
+
+        assert_true('-5' in str(ex.exception) and '-6' in str(ex.exception))
+        sms1 = OutputSMS.objects.get(pk=sms1.pk)
+        sms2 = OutputSMS.objects.get(pk=sms2.pk)
+        assert_equal(sms1.state, ATS_STATES.OK)
+        assert_is_not_none(sms1.sent_at)
+        assert_equal(sms2.state, ATS_STATES.LOCAL_UNKNOWN_ATS_STATE)
+
+    def get_compact_options(self):
+        return (False,), (True,)
+
     @responses.activate
-    def test_command_should_send_and_update_sms(self):
+    @data_provider(get_compact_options)
+    def test_command_should_send_and_update_sms(self, compact):
         responses.add(responses.POST, settings.ATS_URL, content_type='text/xml', status=200,
                       body=self.ATS_SMS_REQUEST_RESPONSE_SENT.format(prefix=settings.ATS_UNIQ_PREFIX,
                                                                      **self.ATS_TEST_UNIQ))
@@ -182,7 +266,7 @@ class OutputSMSTestCase(TestCase):
         sms1 = OutputSMSFactory(pk=self.ATS_TEST_UNIQ['uniq1'], **self.ATS_OUTPUT_SMS1)
         sms2 = OutputSMSFactory(pk=self.ATS_TEST_UNIQ['uniq2'], **self.ATS_OUTPUT_SMS2)
 
-        SendCommand().handle()
+        SendCommand().handle(compact=compact)
 
         sms1 = OutputSMS.objects.get(pk=sms1.pk)
         sms2 = OutputSMS.objects.get(pk=sms2.pk)
@@ -215,6 +299,36 @@ class OutputSMSTestCase(TestCase):
         assert_equal(sms1.state, ATS_STATES.SENT)
         assert_equal(sms2.state, ATS_STATES.DELIVERED)
 
+    @responses.activate
+    def test_command_should_check_delivery_status_only_of_recent_due_sms_with_dlr(self):
+        responses.add(responses.POST, settings.ATS_URL, content_type='text/xml',
+                      body=self.ATS_SMS_DELIVERY_RESPONSE.format(prefix=settings.ATS_UNIQ_PREFIX, **self.ATS_TEST_UNIQ),
+                      status=200)
+
+        now = timezone.now()
+        sms1 = OutputSMSFactory(pk=self.ATS_TEST_UNIQ['uniq1'], sent_at=now - timedelta(minutes=10),
+                                state=ATS_STATES.OK, **self.ATS_OUTPUT_SMS1)
+        sms2 = OutputSMSFactory(pk=self.ATS_TEST_UNIQ['uniq2'], sent_at=now, state=ATS_STATES.OK,
+                                **self.ATS_OUTPUT_SMS2)
+        not_due_sms = OutputSMSFactory(sent_at=now, state=ATS_STATES.OK, next_dlr_check_at=now + timedelta(hours=1))
+        without_dlr_sms = OutputSMSFactory(sent_at=now, state=ATS_STATES.OK, dlr=False)
+        expired_sms = OutputSMSFactory(sent_at=now - timedelta(days=1), state=ATS_STATES.SENT, validity=60)
+
+        CheckDeliveryCommand().handle()
+
+        assert_equal(len(responses.calls), 1)
+        assert_equal(strip_all(responses.calls[0].request.body),
+                     strip_all(self.ATS_SMS_DELIVERY_REQUEST.format(prefix=settings.ATS_UNIQ_PREFIX,
+                                                                    **self.ATS_TEST_UNIQ)))
+        sms1 = OutputSMS.objects.get(pk=sms1.pk)
+        sms2 = OutputSMS.objects.get(pk=sms2.pk)
+        assert_equal(sms1.state, ATS_STATES.SENT)
+        assert_equal(sms1.sent_at, now - timedelta(minutes=10))
+        assert_true(sms1.next_dlr_check_at > sms2.next_dlr_check_at > now)
+        assert_equal(OutputSMS.objects.get(pk=not_due_sms.pk).state, ATS_STATES.OK)
+        assert_equal(OutputSMS.objects.get(pk=without_dlr_sms.pk).state, ATS_STATES.OK)
+        assert_equal(OutputSMS.objects.get(pk=expired_sms.pk).state, ATS_STATES.TIMEOUT)
+
     @responses.activate
     def test_sms_template_should_be_immediately_send(self):
         responses.add(responses.POST, settings.ATS_URL, content_type='text/xml',
@@ -227,6 +341,542 @@ class OutputSMSTestCase(TestCase):
         assert_true('context works' in sms1.content)
         assert_is_not_none(sms1.sent_at)
 
+    @responses.activate
+    def test_command_should_send_sms_in_batches_and_continue_after_failed_batch(self):
+        def send_callback(request):
+            if len(responses.calls) == 0:
+                raise requests.exceptions.HTTPError()
+            return (200, {}, self.ATS_SINGLE_SMS_REQUEST_RESPONSE_SENT.format(
+                settings.ATS_UNIQ_PREFIX + str(self.ATS_TEST_UNIQ['uniq2'])))
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=send_callback)
+
+        sms1 = OutputSMSFactory(pk=self.ATS_TEST_UNIQ['uniq1'], **self.ATS_OUTPUT_SMS1)
+        sms2 = OutputSMSFactory(pk=self.ATS_TEST_UNIQ['uniq2'], **self.ATS_OUTPUT_SMS2)
+
+        SendCommand().handle(batch_size=1)
+
+        assert_equal(OutputSMS.objects.get(pk=sms1.pk).state, ATS_STATES.LOCAL_TO_SEND)
+        assert_equal(OutputSMS.objects.get(pk=sms2.pk).state, ATS_STATES.OK)
+
+    def ok_response_callback(self, request):
+        return ok_response_callback(request)
+
+    @responses.activate
+    def test_command_should_send_sms_batches_concurrently(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+
+        sms_list = [OutputSMSFactory() for _ in range(5)]
+
+        SendCommand().handle(batch_size=1, workers=3)
+
+        assert_equal(len(responses.calls), 5)
+        for sms in sms_list:
+            assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @responses.activate
+    def test_command_should_send_sms_batches_pipelined_and_continue_after_failed_batch(self):
+        sms_list = [OutputSMSFactory() for _ in range(5)]
+
+        def response_callback(request):
+            if 'uniq="{}{}"'.format(settings.ATS_UNIQ_PREFIX, sms_list[2].pk) in force_text(request.body):
+                raise requests.exceptions.ConnectionError()
+            return self.ok_response_callback(request)
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=response_callback)
+
+        SendCommand().handle(batch_size=1, workers=2, pipelined=True, queue_size=1)
+
+        assert_equal(len(responses.calls), 5)
+        for sms in sms_list:
+            assert_equal(OutputSMS.objects.get(pk=sms.pk).state,
+                         ATS_STATES.LOCAL_TO_SEND if sms == sms_list[2] else ATS_STATES.OK)
+
+    @responses.activate
+    def test_command_should_send_only_sms_of_its_shard(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+        sms_list = [OutputSMSFactory() for _ in range(6)]
+
+        SendCommand().handle(shard=1, shards=3)
+
+        for sms in sms_list:
+            assert_equal(OutputSMS.objects.get(pk=sms.pk).state,
+                         ATS_STATES.OK if sms.pk % 3 == 1 else ATS_STATES.LOCAL_TO_SEND)
+        for shard in (0, 2):
+            SendCommand().handle(shard=shard, shards=3)
+        assert_equal(OutputSMS.objects.filter(state=ATS_STATES.OK).count(), 6)
+        assert_equal(len(responses.calls), 3)
+
+    @responses.activate
+    def test_command_should_send_only_sms_of_recipients_of_its_shard(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+        sms_list = [OutputSMSFactory(recipient=recipient)
+                    for recipient in ('+420777000001', '+420777000002', '+420777000003') for _ in range(2)]
+
+        SendCommand().handle(shard=0, shards=2, shard_by='recipient')
+
+        for sms in sms_list:
+            assert_equal(OutputSMS.objects.get(pk=sms.pk).state,
+                         ATS_STATES.OK if get_recipient_shard(sms.recipient, 2) == 0 else ATS_STATES.LOCAL_TO_SEND)
+
+    def test_sms_template_should_be_rendered_from_cache_invalidated_after_template_change(self):
+        assert_true(send_template('+420777000000', slug='test').content.startswith('Does rendering'))
+        sms_template = SMSTemplate.objects.get(slug='test')
+        sms_template.body = 'Changed {{ variable }}'
+        sms_template.save()
+        assert_equal(send_template('+420777000000', slug='test', context={'variable': 'body'}).content,
+                     'Changed body')
+
+    def test_sms_template_with_unknown_slug_should_raise_exception(self):
+        assert_raises(SMSSendingError, send_template, '+420777000000', slug='unknown')
+
+    @responses.activate
+    def test_sms_template_should_be_sent_in_bulk(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+
+        sms_list = send_template_bulk('test', [('+420777111222', {'variable': 'context works'}), '+420777000000'])
+
+        assert_equal(len(responses.calls), 1)
+        sms1, sms2 = [OutputSMS.objects.get(pk=sms.pk) for sms in sms_list]
+        assert_equal(sms1.state, ATS_STATES.OK)
+        assert_true('context works' in sms1.content)
+        assert_is_not_none(sms1.sent_at)
+        assert_equal(sms2.state, ATS_STATES.DEBUG)
+
+    @responses.activate
+    def test_sms_template_sent_in_bulk_to_unavailable_service_should_be_left_to_send(self):
+        def raise_exception(request):
+            raise requests.exceptions.HTTPError()
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=raise_exception)
+
+        sms_list = send_template_bulk('test', ['+420777111222'])
+
+        assert_equal(OutputSMS.objects.get(pk=sms_list[0].pk).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @responses.activate
+    def test_deferred_sms_template_should_be_sent_from_outbox(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+
+        sms = send_template('+420777111222', slug='test', deferred=True)
+
+        assert_equal(len(responses.calls), 0)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.LOCAL_TO_SEND)
+        send_sms_from_outbox([sms.pk])
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+        send_sms_from_outbox([sms.pk])  # Already sent SMS is not claimed again
+        assert_equal(len(responses.calls), 1)
+
+    @responses.activate
+    def test_sms_claimed_by_outbox_should_not_be_sent_again_by_send_sms(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+
+        sms1 = send_template('+420777111222', slug='test', deferred=True)
+        sms2 = send_template('+420777111222', slug='test', deferred=True)
+        # send_sms reads the batch and the outbox sends one of its SMS before the batch is claimed
+        batches = iter_batches(OutputSMS.objects.filter(state=ATS_STATES.LOCAL_TO_SEND))
+        batch = next(batches)
+        send_sms_from_outbox([sms1.pk])
+        send_and_update_sms_states_in_batches(claim_batches(chain([batch], batches)), on_failure=mark_sms_to_send)
+
+        assert_equal(len(responses.calls), 2)
+        request_body = force_text(responses.calls[1].request.body)
+        assert_true('uniq="{}{}"'.format(settings.ATS_UNIQ_PREFIX, sms1.pk) not in request_body)
+        assert_true('uniq="{}{}"'.format(settings.ATS_UNIQ_PREFIX, sms2.pk) in request_body)
+        assert_equal(OutputSMS.objects.get(pk=sms1.pk).state, ATS_STATES.OK)
+        assert_equal(OutputSMS.objects.get(pk=sms2.pk).state, ATS_STATES.OK)
+
+    @responses.activate
+    def test_command_should_send_streamed_sms_batches(self):
+        def response_callback(request):
+            request.body = force_text(b''.join(request.body))  # Streamed body is a generator
+            return self.ok_response_callback(request)
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=response_callback)
+        sms_list = [OutputSMSFactory() for _ in range(3)]
+        config.ATS_STREAM_REQUESTS = True
+        try:
+            SendCommand().handle(batch_size=2)
+        finally:
+            config.ATS_STREAM_REQUESTS = False
+
+        assert_equal(len(responses.calls), 2)
+        for sms in sms_list:
+            assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @responses.activate
+    def test_send_sms_command_should_return_sms_rejected_with_request_error_to_outbox(self):
+        responses.add(responses.POST, settings.ATS_URL, content_type='text/xml',
+                      body='<?xml version="1.0" encoding="UTF-8" ?><status><code>705</code></status>')
+
+        sms = send_template('+420777111222', slug='test', deferred=True)
+        SendCommand().handle()
+
+        assert_equal(len(responses.calls), 1)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @responses.activate
+    def test_send_sms_command_should_return_claimed_sms_to_outbox_after_unexpected_error(self):
+        def raise_exception(request):
+            raise ValueError()
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=raise_exception)
+
+        sms = send_template('+420777111222', slug='test', deferred=True)
+        assert_raises(ValueError, SendCommand().handle)
+
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @responses.activate
+    def test_send_sms_command_should_return_failed_sms_to_outbox(self):
+        responses.add(responses.POST, settings.ATS_URL, status=500)
+
+        sms = send_template('+420777111222', slug='test', deferred=True)
+        SendCommand().handle()
+
+        assert_equal(len(responses.calls), 1)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.LOCAL_TO_SEND)
+
+    def test_rate_limiter_should_keep_daily_budget(self):
+        cache.clear()
+        limiter = RateLimiter(per_second=10, per_day=15)
+        assert_true(limiter.acquire(10))
+        assert_false(limiter.acquire(10))
+        assert_true(limiter.acquire(5))
+        assert_false(limiter.acquire(1))
+
+    @responses.activate
+    def test_sms_template_over_daily_limit_should_be_left_to_send(self):
+        cache.clear()
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+        rate_limiter.per_day = 1
+        try:
+            sms1 = send_template('+420777111222', slug='test')
+            assert_raises(SMSRateLimitError, send_template, '+420777111222', slug='test', pk=246)
+        finally:
+            rate_limiter.per_day = None
+        assert_equal(OutputSMS.objects.get(pk=sms1.pk).state, ATS_STATES.OK)
+        assert_equal(OutputSMS.objects.get(pk=246).state, ATS_STATES.LOCAL_TO_SEND)
+        assert_equal(len(responses.calls), 1)
+
+    def test_rate_limiter_should_release_daily_budget(self):
+        cache.clear()
+        limiter = RateLimiter(per_day=10)
+        assert_true(limiter.acquire(10))
+        limiter.release(4)
+        assert_true(limiter.acquire(4))
+        assert_false(limiter.acquire(1))
+
+    @responses.activate
+    def test_batches_should_be_fitted_to_daily_budget(self):
+        cache.clear()
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+        sms_list = [OutputSMSFactory(state=ATS_STATES.LOCAL_TO_SEND) for _ in range(5)]
+        rate_limiter.per_day = 3
+        try:
+            SendCommand().handle(batch_size=2)
+        finally:
+            rate_limiter.per_day = None
+        # The second batch is split, the rest of it is refused and the sending is stopped
+        assert_equal(len(responses.calls), 2)
+        assert_equal([OutputSMS.objects.get(pk=sms.pk).state for sms in sms_list],
+                     [ATS_STATES.OK] * 3 + [ATS_STATES.LOCAL_TO_SEND] * 2)
+
+    @responses.activate
+    def test_daily_budget_should_be_released_if_ats_did_not_accept_sms(self):
+        cache.clear()
+        calls = []
+
+        def fail_once_callback(request):
+            calls.append(request)
+            if len(calls) == 1:
+                raise requests.exceptions.ConnectTimeout()
+            return self.ok_response_callback(request)
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=fail_once_callback)
+        rate_limiter.per_day = 1
+        try:
+            assert_raises(SMSSendingError, send_template, '+420777111222', slug='test', pk=249)
+            sms = send_template('+420777111222', slug='test')
+        finally:
+            rate_limiter.per_day = None
+        assert_equal(len(calls), 2)
+        assert_equal(OutputSMS.objects.get(pk=249).state, ATS_STATES.LOCAL_TO_SEND)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @responses.activate
+    def test_ats_request_should_be_retried_after_connection_error(self):
+        calls = []
+
+        def fail_once_callback(request):
+            calls.append(request)
+            if len(calls) == 1:
+                raise requests.exceptions.ConnectTimeout()
+            return self.ok_response_callback(request)
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=fail_once_callback)
+        config.ATS_RETRY_MAX_RETRIES, config.ATS_RETRY_BASE_DELAY = 2, 0
+        try:
+            sms = send_template('+420777111222', slug='test')
+        finally:
+            config.ATS_RETRY_MAX_RETRIES, config.ATS_RETRY_BASE_DELAY = 0, 0.5
+        assert_equal(len(calls), 2)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @responses.activate
+    def test_ats_request_should_be_retried_after_refused_connection(self):
+        calls = []
+
+        def fail_once_callback(request):
+            calls.append(request)
+            if len(calls) == 1:
+                raise requests.exceptions.ConnectionError(MaxRetryError(
+                    None, settings.ATS_URL, reason=NewConnectionError(None, 'Connection refused')))
+            return self.ok_response_callback(request)
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=fail_once_callback)
+        config.ATS_RETRY_MAX_RETRIES, config.ATS_RETRY_BASE_DELAY = 1, 0
+        try:
+            sms = send_template('+420777111222', slug='test')
+        finally:
+            config.ATS_RETRY_MAX_RETRIES, config.ATS_RETRY_BASE_DELAY = 0, 0.5
+        assert_equal(len(calls), 2)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @responses.activate
+    def test_ats_request_should_not_be_retried_after_connection_was_aborted(self):
+        def raise_exception(request):
+            raise requests.exceptions.ConnectionError('Connection aborted.')
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=raise_exception)
+        config.ATS_RETRY_MAX_RETRIES, config.ATS_RETRY_BASE_DELAY = 2, 0
+        try:
+            assert_raises(SMSSendingError, send_template, '+420777111222', slug='test', pk=248)
+        finally:
+            config.ATS_RETRY_MAX_RETRIES, config.ATS_RETRY_BASE_DELAY = 0, 0.5
+        assert_equal(len(responses.calls), 1)
+        assert_equal(OutputSMS.objects.get(pk=248).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @responses.activate
+    def test_ats_server_error_should_open_circuit(self):
+        responses.add(responses.POST, settings.ATS_URL, status=503)
+        circuit_breaker.failure_threshold = 1
+        try:
+            assert_raises(SMSSendingError, send_template, '+420777111222', slug='test')
+            assert_true(circuit_breaker.is_open)
+        finally:
+            circuit_breaker.failure_threshold = None
+            circuit_breaker.reset()
+
+    def test_circuit_breaker_should_be_opened_and_probed(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        breaker.record_failure()
+        assert_true(breaker.allow_request())
+        breaker.record_failure()
+        assert_false(breaker.allow_request())
+        time.sleep(0.1)
+        assert_true(breaker.allow_request())
+        assert_false(breaker.allow_request())  # Only one probe is allowed
+        breaker.record_failure()
+        assert_false(breaker.allow_request())
+        time.sleep(0.1)
+        assert_true(breaker.allow_request())
+        breaker.record_success()
+        assert_true(breaker.allow_request())
+        assert_true(breaker.allow_request())
+
+    @responses.activate
+    def test_sms_template_should_not_be_sent_while_circuit_is_open(self):
+        def raise_exception(request):
+            raise requests.exceptions.ConnectionError()
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=raise_exception)
+        circuit_breaker.failure_threshold = 1
+        try:
+            assert_raises(SMSSendingError, send_template, '+420777111222', slug='test')
+            assert_raises(SMSCircuitOpenError, send_template, '+420777111222', slug='test', pk=247)
+        finally:
+            circuit_breaker.failure_threshold = None
+            circuit_breaker.reset()
+        assert_equal(len(responses.calls), 1)
+        assert_equal(OutputSMS.objects.get(pk=247).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @responses.activate
+    def test_sending_of_batches_should_be_stopped_while_circuit_is_open(self):
+        def raise_exception(request):
+            raise requests.exceptions.ConnectionError()
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=raise_exception)
+        sms_list = [OutputSMSFactory(state=ATS_STATES.PROCESSING) for _ in range(3)]
+        failures = []
+        circuit_breaker.failure_threshold = 1
+        try:
+            failed = send_and_update_sms_states_in_batches(
+                [[sms] for sms in sms_list], on_failure=lambda batch, ex: failures.append(ex))
+        finally:
+            circuit_breaker.failure_threshold = None
+            circuit_breaker.reset()
+        assert_equal(failed, 2)
+        assert_equal(len(responses.calls), 1)
+        assert_true(isinstance(failures[1], SMSCircuitOpenError))
+
+    def test_prometheus_metrics_backend_should_render_histograms_and_counters(self):
+        backend = PrometheusMetricsBackend()
+        backend.observe('ats_sms_request_seconds', 0.02)
+        backend.observe('ats_sms_request_seconds', 20)
+        backend.increment('ats_sms_response_codes_total', 3, {'code': 0})
+        rendered = backend.render()
+        assert_true('# TYPE ats_sms_request_seconds histogram' in rendered)
+        assert_true('ats_sms_request_seconds_bucket{le="0.01"} 0\n' in rendered)
+        assert_true('ats_sms_request_seconds_bucket{le="0.025"} 1\n' in rendered)
+        assert_true('ats_sms_request_seconds_bucket{le="+Inf"} 2\n' in rendered)
+        assert_true('ats_sms_request_seconds_count 2\n' in rendered)
+        assert_true('ats_sms_response_codes_total{code="0"} 3\n' in rendered)
+
+    @responses.activate
+    def test_sending_sms_should_be_measured(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+        send_template('+420777111222', slug='test')
+        rendered = force_text(self.client.get('/metrics/').content)
+        for metric_name in ('ats_sms_serialize_seconds_count', 'ats_sms_request_seconds_count',
+                            'ats_sms_request_bytes_count', 'ats_sms_parse_seconds_count',
+                            'ats_sms_response_codes_total{code="0"}'):
+            assert_true(metric_name in rendered, metric_name)
+
+    def test_adaptive_batch_sizer_should_grow_additively_and_shrink_multiplicatively(self):
+        sizer = AdaptiveBatchSizer(min_size=10, max_size=100, initial_size=40, target_duration=1, max_bytes=1000,
+                                   increase_step=20)
+        sizer.record_success(40, 0.5)
+        assert_equal(sizer.batch_size, 60)
+        sizer.record_success(30, 0.5)  # Batch was not full
+        assert_equal(sizer.batch_size, 60)
+        sizer.record_success(60, 0.5)
+        sizer.record_success(80, 0.5)
+        assert_equal(sizer.batch_size, 100)
+        sizer.record_success(100, 2)
+        assert_equal(sizer.batch_size, 50)
+        sizer.record_failure(50)
+        assert_equal(sizer.batch_size, 25)
+        sizer.record_success(25, 0.5, payload_bytes=2000)
+        assert_equal(sizer.batch_size, 12)
+        sizer.record_failure(12)
+        assert_equal(sizer.batch_size, 10)
+
+    @responses.activate
+    def test_sms_should_be_sent_in_adaptive_batches(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=self.ok_response_callback)
+        sms_list = [OutputSMSFactory(state=ATS_STATES.LOCAL_TO_SEND) for _ in range(5)]
+
+        sizer = AdaptiveBatchSizer(min_size=1, max_size=10, initial_size=1, increase_step=1)
+        send_and_update_sms_states_in_batches(iter_batches(OutputSMS.objects.all(), sizer=sizer), sizer=sizer)
+
+        assert_equal([len(re.findall(r'<sms ', force_text(call.request.body))) for call in responses.calls], [1, 2, 2])
+        assert_equal(OutputSMS.objects.filter(pk__in=[sms.pk for sms in sms_list], state=ATS_STATES.OK).count(), 5)
+
+    def send_to_simulator(self, simulator, *ats_requests):
+        ats_url = config.ATS_URL
+        config.ATS_URL = simulator.url
+        try:
+            return send_and_parse_response(*ats_requests)
+        finally:
+            config.ATS_URL = ats_url
+
+    def test_simulator_should_accept_sms_and_report_delivery_progress(self):
+        sms1 = OutputSMSFactory()
+        sms2 = OutputSMSFactory()
+        with ATSSimulator(dlr_sent_after=0.2, dlr_delivered_after=0.4) as simulator:
+            assert_equal(self.send_to_simulator(simulator, sms1), {sms1.pk: ATS_STATES.OK})
+            assert_equal(self.send_to_simulator(simulator, DeliveryRequest(sms1), DeliveryRequest(sms2)),
+                         {sms1.pk: ATS_STATES.NOT_SENT, sms2.pk: ATS_STATES.NOT_FOUND})
+            time.sleep(0.2)
+            assert_equal(self.send_to_simulator(simulator, DeliveryRequest(sms1)), {sms1.pk: ATS_STATES.SENT})
+            time.sleep(0.2)
+            assert_equal(self.send_to_simulator(simulator, DeliveryRequest(sms1)), {sms1.pk: ATS_STATES.DELIVERED})
+
+    def test_simulator_should_inject_errors(self):
+        sms = OutputSMSFactory()
+        with ATSSimulator(error_codes={ATS_STATES.MT_PR_DAILY_LIMIT: 1}) as simulator:
+            assert_equal(self.send_to_simulator(simulator, sms), {sms.pk: ATS_STATES.MT_PR_DAILY_LIMIT})
+        with ATSSimulator(error_codes={ATS_STATES.XML_INVALID: 1}) as simulator:
+            assert_equal(self.send_to_simulator(simulator, sms), {})
+        with ATSSimulator(drop_rate=1) as simulator:
+            assert_raises(SMSSendingError, self.send_to_simulator, simulator, sms)
+
+    @responses.activate
+    def test_worker_should_return_claimed_sms_to_outbox_after_unexpected_error(self):
+        command = WorkerCommand()
+
+        def raise_exception(request):
+            command.stopped.set()
+            raise ValueError()
+
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml', callback=raise_exception)
+        sms = OutputSMSFactory(state=ATS_STATES.LOCAL_TO_SEND)
+        signal_handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        try:
+            command.handle()
+        finally:
+            signal.signal(signal.SIGTERM, signal_handlers[0])
+            signal.signal(signal.SIGINT, signal_handlers[1])
+        assert_equal(len(responses.calls), 1)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @skipIf(getattr(connection.features, 'has_select_for_update_skip_locked', False),
+            'Database claims SMS with SKIP LOCKED')
+    def test_sms_should_be_claimed_by_one_update_with_claim_token(self):
+        sms_list = [OutputSMSFactory(state=ATS_STATES.LOCAL_TO_SEND) for _ in range(3)]
+        claim_sms_to_send([sms_list[0].pk])  # Claimed by another process
+
+        with self.assertNumQueries(3):  # UPDATE, SELECT of the claimed pks and SELECT of the claimed SMS
+            claimed_sms_list = claim_sms_to_send([sms.pk for sms in sms_list])
+
+        assert_equal([sms.pk for sms in claimed_sms_list], [sms_list[1].pk, sms_list[2].pk])
+        assert_equal(claim_sms_to_send([sms.pk for sms in sms_list]), [])
+
+    def test_sms_batches_should_be_claimed_only_once(self):
+        sms_list = [OutputSMSFactory(state=ATS_STATES.LOCAL_TO_SEND) for _ in range(3)]
+        OutputSMSFactory(state=ATS_STATES.OK)
+
+        first_batch = claim_sms_batch(OutputSMS.objects.all(), 2)
+        second_batch = claim_sms_batch(OutputSMS.objects.all(), 2)
+
+        assert_equal([sms.pk for sms in first_batch + second_batch], [sms.pk for sms in sms_list])
+        assert_equal(claim_sms_batch(OutputSMS.objects.all(), 2), [])
+        for sms in sms_list:
+            assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.PROCESSING)
+
+    def assert_uses_index(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN {}'.format(sql), params)
+            plan = ' '.join(force_text(row[-1]) for row in cursor.fetchall())
+            assert_true('USING' in plan and 'INDEX' in plan and 'SCAN' not in plan, plan)
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN {}'.format(sql), params)
+            plan = ' '.join(force_text(row[0]) for row in cursor.fetchall())
+            assert_true('Index' in plan and 'Seq Scan' not in plan, plan)
+
+    def test_commands_queries_should_use_indexes(self):
+        now = timezone.now()
+        self.assert_uses_index(OutputSMS.objects.filter(state=ATS_STATES.LOCAL_TO_SEND, pk__gt=10).order_by('pk'))
+        self.assert_uses_index(OutputSMS.objects.filter(state=ATS_STATES.PROCESSING, changed_at__lt=now))
+        self.assert_uses_index(OutputSMS.objects.filter(
+            Q(next_dlr_check_at__isnull=True) | Q(next_dlr_check_at__lte=now),
+            state__in=(ATS_STATES.OK, ATS_STATES.NOT_SENT, ATS_STATES.SENT), dlr=True).order_by('pk'))
+        self.assert_uses_index(OutputSMS.objects.filter(recipient='+420777111222').order_by('-created_at'))
+
     def test_send_command_should_not_send_empty_request(self):
         SendCommand().handle()
 
@@ -260,7 +910,8 @@ class OutputSMSTestCase(TestCase):
         sms1 = OutputSMSFactory(state=ATS_STATES.PROCESSING, changed_at=timezone.now())
         CleanProcessingCommand().execute()
         assert_equal(OutputSMS.objects.get(pk=sms1.pk).state, ATS_STATES.PROCESSING)
-        sms2 = OutputSMSFactory(state=ATS_STATES.PROCESSING, changed_at=timezone.now() - timedelta(seconds=11))
+        sms2 = OutputSMSFactory(state=ATS_STATES.PROCESSING,
+                                changed_at=timezone.now() - timedelta(seconds=ATS_PROCESSING_TIMEOUT + 1))
         CleanProcessingCommand().execute()
         assert_equal(OutputSMS.objects.get(pk=sms2.pk).state, ATS_STATES.TIMEOUT)
 
@@ -273,3 +924,103 @@ class OutputSMSTestCase(TestCase):
         assert_raises(SMSSendingError, send_template, '+420777111222', slug='test',
                       context={'variable': 'context works'}, pk=245)
         assert_equal(OutputSMS.objects.get(pk=245).state, ATS_STATES.LOCAL_TO_SEND)
+
+
+class OutputSMSTransactionTestCase(TransactionTestCase):
+    """
+    Tests of actions performed after the transaction is committed, they cannot run inside of the test transaction.
+    """
+
+    def setUp(self):
+        super(OutputSMSTransactionTestCase, self).setUp()
+        SMSTemplateFactory()
+
+    @skipUnless(hasattr(transaction, 'on_commit'), 'Django >= 1.9 is required')
+    def test_sms_template_cache_should_be_invalidated_again_after_commit(self):
+        with transaction.atomic():
+            sms_template = SMSTemplate.objects.get(slug='test')
+            sms_template.body = 'Changed {{ variable }}'
+            sms_template.save()
+            # Template cached before the commit (e.g. by another thread) would be stale
+            sms_template_cache.get('test')
+            assert_true('test' in sms_template_cache._templates)
+        assert_false('test' in sms_template_cache._templates)
+        assert_equal(send_template('+420777000000', slug='test', context={'variable': 'body'}).content,
+                     'Changed body')
+
+    @responses.activate
+    def test_sms_templates_sent_in_sms_batch_should_be_sent_in_one_request(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=ok_response_callback)
+
+        @sms_batch()
+        def notify(recipient):
+            return send_template(recipient, slug='test')
+
+        with sms_batch():
+            sms_list = [send_template('+420777111222', slug='test'), notify('+420777111222')]
+            with sms_batch():
+                sms_list.append(send_template('+420777111222', slug='test'))
+            assert_equal(len(responses.calls), 0)
+
+        assert_equal(len(responses.calls), 1)
+        for sms in sms_list:
+            assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+        notify('+420777111222')
+        assert_equal(len(responses.calls), 2)
+
+    @responses.activate
+    def test_sms_batch_that_raised_exception_should_not_be_sent(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=ok_response_callback)
+
+        def send_and_fail():
+            with sms_batch():
+                send_template('+420777111222', slug='test', pk=250)
+                raise ValueError()
+
+        assert_raises(ValueError, send_and_fail)
+        assert_equal(len(responses.calls), 0)
+        assert_equal(OutputSMS.objects.get(pk=250).state, ATS_STATES.LOCAL_TO_SEND)
+
+    @responses.activate
+    def test_sms_batch_rolled_back_with_transaction_should_not_be_sent(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=ok_response_callback)
+
+        def send_and_fail():
+            with transaction.atomic():
+                with sms_batch():
+                    send_template('+420777111222', slug='test', pk=251)
+                    raise ValueError()
+
+        assert_raises(ValueError, send_and_fail)
+        assert_equal(len(responses.calls), 0)
+        assert_false(OutputSMS.objects.filter(pk=251).exists())
+
+    @skipUnless(hasattr(transaction, 'on_commit'), 'Django >= 1.9 is required')
+    @responses.activate
+    def test_sms_batch_inside_transaction_should_be_sent_after_commit(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=ok_response_callback)
+
+        with transaction.atomic():
+            with sms_batch():
+                sms = send_template('+420777111222', slug='test')
+            assert_equal(len(responses.calls), 0)
+
+        assert_equal(len(responses.calls), 1)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.OK)
+
+    @skipIf(hasattr(transaction, 'on_commit'), 'Django < 1.9 is required')
+    @responses.activate
+    def test_sms_batch_on_commit_should_be_left_in_outbox_without_commit_hooks(self):
+        responses.add_callback(responses.POST, settings.ATS_URL, content_type='text/xml',
+                               callback=ok_response_callback)
+
+        with transaction.atomic():
+            with sms_batch(on_commit=True):
+                sms = send_template('+420777111222', slug='test')
+
+        assert_equal(len(responses.calls), 0)
+        assert_equal(OutputSMS.objects.get(pk=sms.pk).state, ATS_STATES.LOCAL_TO_SEND)
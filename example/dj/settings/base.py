@@ -220,3 +220,5 @@ ATS_URL = 'http://fik.atspraha.cz/gwfcgi/XMLServerWrapper.fcgi'
 ATS_SMS_DEBUG = True
 ATS_WHITELIST = ('+420777111222',)
 ATS_UNIQ_PREFIX = 'ACCEPT'
+ATS_OUTBOX_THREAD = False  # Deferred SMS are sent by the send_sms command (or explicitly in tests)
+ATS_METRICS_BACKEND = 'ats_sms_operator.metrics.PrometheusMetricsBackend'
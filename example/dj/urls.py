@@ -4,12 +4,16 @@ from django.conf.urls import include, patterns, url
 from is_core.site import site
 
 from ats_sms_operator.cores.resources import InputATSSMSmessageResource
+from ats_sms_operator.metrics import metrics_view
 
 
 urlpatterns = patterns(
     '',
     url(r'^', include(site.urls)),
     url(r'^api/atsinputsmsmessage/$', InputATSSMSmessageResource.as_view(callback_function=lambda x, y: x)),
+    url(r'^api/atsinputsmsmessage/bulk/$', InputATSSMSmessageResource.as_view(callback_function=lambda x, y: x,
+                                                                              bulk_create=True)),
+    url(r'^metrics/$', metrics_view),
 )
 
 if settings.DEBUG:
@@ -30,8 +30,6 @@ setup(
     ],
     install_requires=[
         'django>=1.6',
-        'beautifulsoup4>=4.4.0',
-        'html5lib>=0.999999',
         'django-ipware>=1.0.0',
         'requests==2.9.0',
     ],